@@ -0,0 +1,106 @@
+"""
+Checks that cleaner.invert_attributes gives the same output as the regex it replaced.
+
+A few fixed cases (a '>' inside an attribute value before or after the id/class pair,
+uppercase names, several pairs in a tag) are checked first, then random well-formed
+documents: start tags with id, class and other attributes (values may hold '>' and
+the other kind of quote, never '<'), end tags, comments and text.
+
+Usage:
+    python benchmarks/cleaner_parity.py
+    python benchmarks/cleaner_parity.py --count 100000 --seed 3
+"""
+import os
+import re
+import sys
+import random
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from modules.cleaner import invert_attributes
+
+# The regex invert_attributes replaced
+FORMER_PATTERN = re.compile(r'(<[^>]+)\s+(id="[^"]*")(\s+)(class="[^"]*")', re.IGNORECASE)
+
+# (document, expected output)
+CASES = [
+    ('<p id="a" class="b">x</p>', '<p class="b" id="a">x</p>'),
+    # The former regex can't get past a '>' in a value before the pair...
+    ('<p title="a > b" id="a" class="b">x</p>', '<p title="a > b" id="a" class="b">x</p>'),
+    ('<a onclick="x>1" id="a" class="b">x</a>', '<a onclick="x>1" id="a" class="b">x</a>'),
+    # ...but one after the pair, or inside the id value, doesn't matter
+    ('<a id="a" class="b" onclick="x>1">x</a>', '<a class="b" id="a" onclick="x>1">x</a>'),
+    ('<p id="a>1" class="b">x</p>', '<p class="b" id="a>1">x</p>'),
+    # Only a whole id attribute counts
+    ('<p data-id="a" class="b">x</p>', '<p data-id="a" class="b">x</p>'),
+    ('<P ID="a"\n  CLASS="b">x</P>', '<P CLASS="b"\n  ID="a">x</P>'),
+    # One swap per tag: the last pair
+    ('<p id="a" class="b" id="c" class="d">x</p>', '<p id="a" class="b" class="d" id="c">x</p>'),
+    ('<p title=\'say "hi"\' id="a" class="b"/>', '<p title=\'say "hi"\' class="b" id="a"/>'),
+    # Comments are not skipped
+    ('<!-- id="a" class="b" -->', '<!-- class="b" id="a" -->'),
+    # After a swap, a pair with no '<' of its own (here, an unclosed tag) is left alone
+    ('<p id="a" class="b"\nid="c" class="', '<p class="b" id="a"\nid="c" class="'),
+]
+
+TAG_NAMES = ['p', 'div', 'span', 'h2', 'img', 'a', 'P']
+ATTRIBUTES = [
+    'id="_idX1"', 'id="a"', 'ID="q"', 'id="a>b"', 'id=""', 'data-id="z"',
+    'class="negrito"', 'class="_1-Titulo-1"', 'CLASS="r"', 'class=""',
+    'lang="pt"', 'xml:lang="pt"', 'title="a > b"', 'onclick="x>1"', "data-x='>'",
+    "title='say \"hi\"'", 'alt="x"', 'hidden',
+]
+SPACES = [' ', ' ', ' ', '  ', '\n', '\n  ', '\t']
+TEXTS = ['texto', 'a &gt; b', 'id="x" class="y"', ' ', '\n']
+
+def former_invert(content):
+    return FORMER_PATTERN.sub(r'\1 \4\3\2', content)
+
+def random_document(rng):
+    pieces = []
+    for _ in range(rng.randint(1, 6)):
+        kind = rng.random()
+        if kind < 0.6:
+            name = rng.choice(TAG_NAMES)
+            attributes = ''.join(rng.choice(SPACES) + rng.choice(ATTRIBUTES) for _ in range(rng.randint(0, 5)))
+            pieces.append(f"<{name}{attributes}{rng.choice(['', '', '/', ' /', ' '])}>")
+        elif kind < 0.75:
+            pieces.append(f"</{rng.choice(TAG_NAMES)}>")
+        elif kind < 0.8:
+            pieces.append(f"<!-- {rng.choice(TEXTS)} -->")
+        else:
+            pieces.append(rng.choice(TEXTS))
+    return ''.join(pieces)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare invert_attributes with the regex it replaced")
+    parser.add_argument("--count", type=int, default=30000, help="Random documents to check (default: 30000)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = 0
+    for document, expected in CASES:
+        output, _ = invert_attributes(document)
+        if output != expected or former_invert(document) != expected:
+            failures += 1
+            print(f"case {document!r}: expected {expected!r}, got {output!r} (former regex: {former_invert(document)!r})")
+
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for _ in range(args.count):
+        document = random_document(rng)
+        output, _ = invert_attributes(document)
+        expected = former_invert(document)
+        if output != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f"{document!r}\n  former {expected!r}\n  new    {output!r}")
+
+    print(f"Fixed cases: {len(CASES) - failures}/{len(CASES)} ok. Random documents: {mismatches} mismatches in {args.count}.")
+    sys.exit(1 if failures or mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+Local stand-in for the OpenAI-compatible /v1/chat/completions endpoint used by
+topic_identifier, so the AI stage (concurrency, caching, deadlines, circuit breaker)
+can be measured offline.
+
+It answers the topic prompts the way the model is asked to (uppercase rows are
+topics), with a configurable latency distribution, a usage block, injected errors
+and timeouts, and reasoning-style answers. Answers can be streamed (SSE) and
+generated at a fixed token rate, with extra chatter after the JSON answer like
+reasoning models tend to write (left out when a response_format is requested).
+
+Usage:
+    python benchmarks/mock_llm_server.py --port 8000 --latency lognormal:-0.7,0.5
+    python benchmarks/mock_llm_server.py --latency uniform:0.2,2 --error-rate 0.1 --timeout-rate 0.05
+    python benchmarks/mock_llm_server.py --max-concurrency 1   # behaves like a single-slot LM Studio host
+    python benchmarks/mock_llm_server.py --tokens-per-second 30 --chatter 300   # slow model that keeps talking
+
+Then point the pipeline at it:
+    AI_API_URL=http://127.0.0.1:8000/v1/chat/completions python main.py
+
+GET /stats returns the request counters (and the peak number of requests in flight).
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution, in seconds:
+    fixed:S, uniform:MIN,MAX, normal:MEAN,SD, lognormal:MU,SIGMA, exp:MEAN
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',')] if args else []
+    samplers = {
+        "fixed": lambda rng: values[0],
+        "uniform": lambda rng: rng.uniform(values[0], values[1]),
+        "normal": lambda rng: max(0.0, rng.gauss(values[0], values[1])),
+        "lognormal": lambda rng: rng.lognormvariate(values[0], values[1]),
+        "exp": lambda rng: rng.expovariate(1 / values[0]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    return samplers[kind]
+
+def is_topic(text):
+    letters = [c for c in text if c.isalpha()]
+    return len(letters) >= 3 and sum(1 for c in letters if c.isupper()) / len(letters) >= 0.8
+
+def answer_rows(block):
+    """
+    Topic indices of a "Row N: text" block; the last row is never a topic.
+    """
+    rows = re.findall(r'^Row (\d+): (.*)$', block, re.MULTILINE)
+    return [int(n) for n, text in rows[:-1] if is_topic(text)]
+
+def answer_prompt(prompt):
+    """
+    Returns the answer text for a single-table (JSON array) or batch (JSON object) prompt.
+    """
+    tables = re.split(r'^Table (T\d+):$', prompt, flags=re.MULTILINE)
+    if len(tables) > 1:
+        # [preamble, id, block, id, block, ...]
+        return json.dumps({table_id: answer_rows(block) for table_id, block in zip(tables[1::2], tables[2::2])})
+    return json.dumps(answer_rows(prompt))
+
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+def split_tokens(text):
+    # About 4 characters per streamed token, like count_tokens
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+CHATTER = " The rows written in uppercase introduce the sections of the table, so they are the topic headers."
+
+def chatter_text(tokens):
+    """
+    Text of about tokens tokens written after the answer.
+    """
+    if not tokens:
+        return ""
+    text = "\n\nExplanation:"
+    while count_tokens(text) < tokens:
+        text += CHATTER
+    return text[:tokens * 4]
+
+
+class MockSettings:
+    def __init__(self, latency="fixed:0.2", error_rate=0.0, error_status=500, timeout_rate=0.0,
+                 hang=120.0, reasoning_rate=0.0, malformed_rate=0.0, max_concurrency=0, seed=None,
+                 tokens_per_second=0.0, chatter=0):
+        self.sample_latency = parse_latency(latency)
+        # Generation speed after the first token (0 = instantaneous) and tokens written after the answer
+        self.tokens_per_second = tokens_per_second
+        self.chatter = chatter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.reasoning_rate = reasoning_rate
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        # Emulates hosts that only run N generations at a time (the rest queue up)
+        self.slots = threading.Semaphore(max_concurrency) if max_concurrency else None
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "timeouts": 0, "malformed": 0,
+                      "reasoning": 0, "streams": 0, "cancelled": 0, "in_flight": 0, "peak_in_flight": 0,
+                      "tokens": 0}
+        self.stats_lock = threading.Lock()
+
+    def draw(self):
+        """
+        Draws the fate of one request: (latency, outcome).
+        """
+        with self.rng_lock:
+            latency = self.sample_latency(self.rng)
+            roll = self.rng.random()
+            if roll < self.error_rate:
+                outcome = "error"
+            elif roll < self.error_rate + self.timeout_rate:
+                outcome = "timeout"
+            elif roll < self.error_rate + self.timeout_rate + self.malformed_rate:
+                outcome = "malformed"
+            elif self.rng.random() < self.reasoning_rate:
+                outcome = "reasoning"
+            else:
+                outcome = "ok"
+        return latency, outcome
+
+    def count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+            if key == "in_flight":
+                self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = None
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, payload):
+        # One server-sent event as one HTTP chunk
+        data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.settings.stats_lock:
+                self.send_json(200, dict(self.settings.stats))
+        elif self.path in ("/health", "/v1/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+        except json.JSONDecodeError:
+            self.send_json(400, {"error": {"message": "Invalid JSON"}})
+            return
+        if self.path != "/v1/chat/completions":
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        settings = self.settings
+        settings.count("requests")
+        settings.count("in_flight")
+        try:
+            if settings.slots:
+                settings.slots.acquire()
+            try:
+                self.complete(request, *settings.draw())
+            finally:
+                if settings.slots:
+                    settings.slots.release()
+        finally:
+            settings.count("in_flight", -1)
+
+    def complete(self, request, latency, outcome):
+        settings = self.settings
+        # latency is the time to the first token
+        if outcome == "timeout":
+            settings.count("timeouts")
+            time.sleep(settings.hang)
+        else:
+            time.sleep(latency)
+
+        if outcome == "error":
+            settings.count("errors")
+            self.send_json(settings.error_status, {"error": {"message": "Injected error"}})
+            return
+
+        prompt = request["messages"][-1]["content"]
+        answer = answer_prompt(prompt)
+        # A constrained (response_format) answer has nothing after the JSON
+        content = answer if request.get("response_format") else answer + chatter_text(settings.chatter)
+        reasoning = None
+        if outcome == "malformed":
+            settings.count("malformed")
+            content = "I think the first row looks like a header."
+        elif outcome == "reasoning":
+            settings.count("reasoning")
+            content = ""
+            reasoning = f"The uppercase rows are headers, the last row never is. So the answer is {answer}"
+
+        prompt_tokens = sum(count_tokens(m.get("content", "")) for m in request.get("messages", []))
+        completion_tokens = count_tokens(content + (reasoning or ""))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        settings.count("tokens", prompt_tokens + completion_tokens)
+        settings.count("ok")
+        header = {
+            "id": f"chatcmpl-mock-{settings.stats['requests']}",
+            "created": int(time.time()),
+            "model": request.get("model", "mock-model")
+        }
+        if request.get("stream"):
+            self.stream(header, content, reasoning, usage if (request.get("stream_options") or {}).get("include_usage") else None)
+            return
+
+        if settings.tokens_per_second:
+            time.sleep(completion_tokens / settings.tokens_per_second)
+        message = {"role": "assistant", "content": content}
+        if reasoning is not None:
+            message["reasoning"] = reasoning
+        self.send_json(200, dict(header, object="chat.completion", usage=usage,
+                                 choices=[{"index": 0, "message": message, "finish_reason": "stop"}]))
+
+    def stream(self, header, content, reasoning, usage):
+        """
+        Sends the answer as server-sent events, one token per event at the
+        configured rate. A client closing the stream early counts as cancelled.
+        """
+        settings = self.settings
+        settings.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        pieces = [("reasoning", piece) for piece in split_tokens(reasoning or "")]
+        pieces += [("content", piece) for piece in split_tokens(content)]
+        chunk = dict(header, object="chat.completion.chunk")
+        try:
+            for field, piece in pieces:
+                if settings.tokens_per_second:
+                    time.sleep(1 / settings.tokens_per_second)
+                self.send_event(dict(chunk, choices=[{"index": 0, "delta": {field: piece}, "finish_reason": None}]))
+            self.send_event(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+            if usage:
+                self.send_event(dict(chunk, choices=[], usage=usage))
+            self.send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            settings.count("cancelled")
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, host="127.0.0.1", **settings):
+    """
+    Starts the mock server on a background thread. Returns (server, url of the
+    chat completions endpoint); call server.shutdown() to stop it.
+    port=0 picks a free port.
+    """
+    handler = type("BoundMockHandler", (MockHandler,), {"settings": MockSettings(**settings)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1/chat/completions"
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="fixed:0.2",
+                        help="fixed:S, uniform:MIN,MAX, normal:MEAN,SD, lognormal:MU,SIGMA or exp:MEAN (seconds, default: fixed:0.2)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an HTTP error")
+    parser.add_argument("--error-status", type=int, default=500, help="Status of the injected errors (default: 500)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Fraction of requests that hang for --hang seconds")
+    parser.add_argument("--hang", type=float, default=120.0, help="Seconds a timed-out request hangs (default: 120)")
+    parser.add_argument("--reasoning-rate", type=float, default=0.0, help="Fraction of answers given only in the 'reasoning' field")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of answers without a parsable array")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="Requests processed at once, the rest queue (default: unlimited)")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Generation speed after the first token (default: instantaneous)")
+    parser.add_argument("--chatter", type=int, default=0, help="Tokens of explanation written after the JSON answer (default: 0)")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible runs")
+    args = parser.parse_args()
+
+    server, url = start_server(
+        args.port, args.host, latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+        timeout_rate=args.timeout_rate, hang=args.hang, reasoning_rate=args.reasoning_rate,
+        malformed_rate=args.malformed_rate, max_concurrency=args.max_concurrency, seed=args.seed,
+        tokens_per_second=args.tokens_per_second, chatter=args.chatter
+    )
+    print(f"Mock LLM listening on {url} (stats: http://{args.host}:{server.server_address[1]}/stats)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Checks that the lxml parser backends (Config.HTML_PARSER) give the same books as html.parser.
+
+Each ePub is processed once per parser (without AI and caches) and every XHTML file of
+the outputs is compared with the html.parser output as XML: canonical form (C14N) of the
+root element, so attribute order, CDATA sections and self-closing syntax don't count,
+plus the XML declaration and the DOCTYPE. The time spent parsing the documents of the
+inputs is reported too.
+
+Usage:
+    python benchmarks/parser_parity.py
+    python benchmarks/parser_parity.py input/*.epub --parsers xhtml
+"""
+import io
+import os
+import re
+import sys
+import glob
+import time
+import shutil
+import logging
+import zipfile
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+from lxml import etree
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from config import Config
+from main import process_file
+from utils.markup import PARSERS, XML_DECLARATION, parse
+
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+DOCTYPE = re.compile(r'<!DOCTYPE[^>]*>', re.IGNORECASE)
+
+def xhtml_members(epub_path):
+    """
+    Returns {member name: text} of the XHTML files of an ePub.
+    """
+    with zipfile.ZipFile(epub_path) as z:
+        return {name: z.read(name).decode('utf-8') for name in z.namelist() if name.lower().endswith(('.xhtml', '.html'))}
+
+def canonical(text):
+    """
+    Returns (XML declaration, DOCTYPE, C14N of the root element) of a document,
+    or raises etree.XMLSyntaxError if it is not well-formed XML.
+    """
+    declaration = XML_DECLARATION.match(text)
+    doctype = DOCTYPE.search(text)
+    root = etree.fromstring(text.encode('utf-8'), etree.XMLParser(resolve_entities=False))
+    return (
+        declaration.group(1) if declaration else None,
+        doctype.group().lower() if doctype else None,
+        etree.tostring(root, method="c14n")
+    )
+
+def first_difference(a, b):
+    i = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+    return f"...{a[max(i - 60, 0):i + 60]!r}... vs ...{b[max(i - 60, 0):i + 60]!r}..."
+
+def compare_outputs(reference, candidate):
+    """
+    Compares the XHTML files of two output ePubs. Returns the list of differences.
+    """
+    expected = xhtml_members(reference)
+    actual = xhtml_members(candidate)
+    problems = []
+    for name in sorted(set(expected) | set(actual)):
+        if name not in expected or name not in actual:
+            problems.append(f"{name}: only in {'reference' if name in expected else 'candidate'}")
+            continue
+        try:
+            a = canonical(expected[name])
+        except etree.XMLSyntaxError as e:
+            # html.parser doesn't check well-formedness, so its output isn't always XML
+            problems.append(f"{name}: html.parser output is not well-formed XML ({e})")
+            continue
+        try:
+            b = canonical(actual[name])
+        except etree.XMLSyntaxError as e:
+            problems.append(f"{name}: output is not well-formed XML ({e})")
+            continue
+        for label, x, y in zip(("XML declaration", "DOCTYPE", "content"), a, b):
+            if x != y:
+                detail = first_difference(x.decode('utf-8'), y.decode('utf-8')) if label == "content" else f"{x!r} vs {y!r}"
+                problems.append(f"{name}: {label} differs: {detail}")
+    return problems
+
+def parse_time(epub_path, parser):
+    """
+    Seconds spent parsing and serializing the XHTML files of an ePub once.
+    """
+    texts = list(xhtml_members(epub_path).values())
+    start = time.perf_counter()
+    for text in texts:
+        str(parse(text, parser))
+    return time.perf_counter() - start
+
+def run_book(epub_path, parser, tmp_dir):
+    output = os.path.join(tmp_dir, f"{parser}.epub")
+    Config.HTML_PARSER = parser
+    with redirect_stdout(io.StringIO()):
+        result = process_file(epub_path, output, qr_report_path=os.path.join(tmp_dir, f"{parser}_qr.txt"),
+                              use_cache=False, enable_ai=False)
+    if not result["ok"]:
+        raise RuntimeError(f"process_file failed with {parser}: {result['error']}")
+    return output
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the lxml parser backends with html.parser")
+    parser.add_argument("epubs", nargs="*", help="ePubs to check (default: benchmarks/corpus/*.epub)")
+    parser.add_argument("--parsers", nargs="+", choices=[p for p in PARSERS if p != "html.parser"], default=["lxml", "xhtml"])
+    args = parser.parse_args()
+
+    epubs = [os.path.abspath(path) for path in args.epubs] or sorted(glob.glob(os.path.join(CORPUS_DIR, "*.epub")))
+    if not epubs:
+        parser.error("no ePub given and benchmarks/corpus/ is empty (see synthetic_epub.py)")
+
+    # Modules resolve assets/ relative to the working directory
+    os.chdir(PROJECT_ROOT)
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s - %(message)s')
+
+    failed = False
+    for epub_path in epubs:
+        print(f"\n=== {os.path.basename(epub_path)} ===")
+        baseline_time = parse_time(epub_path, "html.parser")
+        print(f"{'html.parser':<12} parse+serialize {baseline_time:.3f}s")
+        tmp_dir = tempfile.mkdtemp(prefix="epub_parity_")
+        try:
+            reference = run_book(epub_path, "html.parser", tmp_dir)
+            for backend in args.parsers:
+                seconds = parse_time(epub_path, backend)
+                problems = compare_outputs(reference, run_book(epub_path, backend, tmp_dir))
+                status = "equivalent" if not problems else f"{len(problems)} differences"
+                print(f"{backend:<12} parse+serialize {seconds:.3f}s (x{baseline_time / seconds:.1f})  {status}")
+                for problem in problems[:20]:
+                    print(f"  {problem}")
+                failed = failed or bool(problems)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
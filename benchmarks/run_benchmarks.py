@@ -0,0 +1,201 @@
+"""
+Times each pipeline module's run() and the full process_file on synthetic ePubs.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes small medium --repeat 3
+    python benchmarks/run_benchmarks.py --sizes huge --ai-url http://localhost:1234/v1/chat/completions
+    python benchmarks/run_benchmarks.py --sizes medium --mock-ai lognormal:-0.7,0.5 --no-topic-rules
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/bench-20250101-120000.json
+
+Results are written as JSON to benchmarks/results/ so runs can be compared.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+from contextlib import contextmanager, redirect_stdout
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from config import Config
+from main import process_file
+from utils.epub_wrapper import open_book
+from utils.document_store import DocumentStore
+from modules import cleaner, structure, interactivity, topic_identifier, ncx_generator, auditor, url_linker, qr_scanner, font_injector
+from synthetic_epub import SIZES, generate_epub
+from mock_llm_server import start_server
+
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+@contextmanager
+def timer(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+def run_stages(epub_path, tmp_dir, enable_ai, topic_rules=True):
+    """
+    Runs the pipeline stage by stage (same order as process_file) and returns {stage: seconds}.
+    """
+    timings = {}
+    with timer(timings, "open"):
+        book = open_book(epub_path, os.path.join(tmp_dir, "work"))
+        store = DocumentStore(book)
+    try:
+        with timer(timings, "audit_before"):
+            auditor.count_elements(store, "BEFORE")
+        with timer(timings, "cleaner"):
+            cleaner.run(store)
+        with timer(timings, "qr_scanner"):
+            qr_scanner.run(store, os.path.join(tmp_dir, "qr_code_report.txt"), use_cache=False)
+        with timer(timings, "structure"):
+            structure.run(store)
+        with timer(timings, "font_injector"):
+            font_injector.run(book)
+        with timer(timings, "interactivity"):
+            interactivity.run(store)
+        with timer(timings, "url_linker"):
+            url_linker.run(store)
+        if enable_ai:
+            with timer(timings, "topic_identifier"):
+                topic_identifier.run(store, use_cache=False, use_rules=topic_rules)
+        with timer(timings, "ncx_generator"):
+            ncx_generator.run(book)
+        with timer(timings, "audit_after"):
+            auditor.count_elements(store, "AFTER")
+        with timer(timings, "package"):
+            store.flush()
+            book.package(os.path.join(tmp_dir, "stages_output.epub"))
+    finally:
+        book.close()
+    return timings
+
+def summarize(samples):
+    return {"min": min(samples), "median": statistics.median(samples), "runs": len(samples)}
+
+def corpus_path(size):
+    """
+    Generates the corpus ePub of a preset size once and reuses it afterwards.
+    """
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    path = os.path.join(CORPUS_DIR, f"{size}.epub")
+    if not os.path.exists(path):
+        print(f"Generating {size} corpus...")
+        generate_epub(path, **SIZES[size])
+    return path
+
+def bench_size(size, repeat, enable_ai, topic_rules=True):
+    epub_path = corpus_path(size)
+    stage_samples = {}
+    full_samples = []
+
+    for _ in range(repeat):
+        tmp_dir = tempfile.mkdtemp(prefix="epub_bench_")
+        try:
+            with redirect_stdout(io.StringIO()):
+                for name, seconds in run_stages(epub_path, tmp_dir, enable_ai, topic_rules).items():
+                    stage_samples.setdefault(name, []).append(seconds)
+
+                start = time.perf_counter()
+                result = process_file(epub_path, os.path.join(tmp_dir, "output.epub"),
+                                      qr_report_path=os.path.join(tmp_dir, "qr_code_report.txt"),
+                                      use_cache=False, enable_ai=enable_ai, topic_rules=topic_rules)
+                full_samples.append(time.perf_counter() - start)
+            if not result["ok"]:
+                raise RuntimeError(f"process_file failed on {size}: {result['error']}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        "params": SIZES[size],
+        "input_bytes": os.path.getsize(epub_path),
+        "stages": {name: summarize(samples) for name, samples in stage_samples.items()},
+        "process_file": summarize(full_samples)
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def print_results(results, previous=None):
+    for size, data in results["sizes"].items():
+        old = (previous or {}).get("sizes", {}).get(size)
+        print(f"\n=== {size} ({data['params']['files']} files, {data['input_bytes']} bytes) ===")
+        rows = list(data["stages"].items()) + [("process_file", data["process_file"])]
+        for name, timing in rows:
+            line = f"{name:<20} {timing['median']:>9.4f}s (min {timing['min']:.4f}s)"
+            if old:
+                old_timing = old["process_file"] if name == "process_file" else old["stages"].get(name)
+                if old_timing and old_timing["median"] > 0:
+                    line += f"  x{timing['median'] / old_timing['median']:.2f} vs previous"
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ePub pipeline on synthetic books")
+    parser.add_argument("--sizes", nargs="+", choices=SIZES.keys(), default=["small", "medium", "huge"])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size (default: 3)")
+    parser.add_argument("--ai-url", help="Chat completions endpoint for the AI stage (skipped if not given)")
+    parser.add_argument("--mock-ai", metavar="LATENCY",
+                        help="Measure the AI stage against the local mock server with this latency distribution (e.g. fixed:0.2)")
+    parser.add_argument("--no-topic-rules", action="store_true", help="Send every table to the AI (the synthetic tables are all clear-cut)")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/bench-<timestamp>.json)")
+    args = parser.parse_args()
+
+    # Modules resolve assets/ relative to the working directory
+    os.chdir(PROJECT_ROOT)
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+
+    mock_server = None
+    if args.mock_ai:
+        mock_server, Config.AI_API_URL = start_server(latency=args.mock_ai, seed=0)
+    elif args.ai_url:
+        Config.AI_API_URL = args.ai_url
+    enable_ai = bool(args.ai_url or args.mock_ai)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "ai": enable_ai,
+        "mock_ai": args.mock_ai,
+        "topic_rules": not args.no_topic_rules,
+        "sizes": {}
+    }
+    for size in args.sizes:
+        print(f"Benchmarking {size}...")
+        results["sizes"][size] = bench_size(size, args.repeat, enable_ai, not args.no_topic_rules)
+    if mock_server:
+        results["mock_ai_stats"] = mock_server.RequestHandlerClass.settings.stats
+        mock_server.shutdown()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Generates synthetic ePubs shaped like our InDesign exports, so the pipeline can be
+measured without client books.
+
+Usage:
+    python benchmarks/synthetic_epub.py output.epub --size medium
+    python benchmarks/synthetic_epub.py output.epub --files 40 --tables 3 --qr-images 5
+"""
+import io
+import os
+import random
+import zipfile
+import argparse
+from PIL import Image, ImageDraw
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+# Preset corpus sizes used by the benchmark runner
+SIZES = {
+    "small": {"files": 5, "paragraphs": 20, "figures": 2, "tables": 1, "rows": 6, "activities": 2, "qr_images": 2},
+    "medium": {"files": 50, "paragraphs": 40, "figures": 3, "tables": 2, "rows": 8, "activities": 3, "qr_images": 10},
+    "huge": {"files": 300, "paragraphs": 60, "figures": 4, "tables": 3, "rows": 10, "activities": 4, "qr_images": 40},
+}
+
+WORDS = (
+    "paciente tratamento diagnóstico clínico avaliação sintomas conduta exame "
+    "terapia dose evidência estudo risco fator quadro agudo crônico manejo "
+    "protocolo indicação resposta seguimento internação cuidado família equipe"
+).split()
+
+class IdGenerator:
+    """
+    Produces the _idContainer/_idTextAnchor/_idParaDest style ids of InDesign exports.
+    """
+
+    def __init__(self):
+        self.counter = 0
+
+    def next(self, prefix):
+        self.counter += 1
+        return f"_id{prefix}{self.counter:03d}"
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def paragraph(rng, ids):
+    text = " ".join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(1, 4)))
+    if rng.random() < 0.1:
+        text += f" Disponível em: https://portal.example.com/artigo/{rng.randint(1000, 9999)}"
+    if rng.random() < 0.3:
+        word = rng.choice(WORDS)
+        text = text.replace(word, f'<span class="negrito">{word}</span>', 1)
+    return f'<p class="_1-Corpo-de-texto" id="{ids.next("ParaDest-")}" lang="pt-BR">{text}</p>'
+
+def figure(src, ids):
+    return (
+        f'<div id="{ids.next("Container")}">'
+        f'<div class="Inline-Figure"><div class="Inline-Figure-1" id="{ids.next("Container")}">'
+        f'<img class="_idGenObjectStyle-Disabled" src="{src}" alt="" />'
+        '</div></div></div>'
+    )
+
+def table(rng, rows, ids):
+    body = []
+    for i in range(rows):
+        if i == 0 or (i < rows - 1 and rng.random() < 0.2):
+            cell = " ".join(rng.choice(WORDS) for _ in range(3)).upper()
+        elif rng.random() < 0.2:
+            cell = "• " + sentence(rng, 6)
+        else:
+            cell = sentence(rng, rng.randint(4, 25))
+        body.append(f'<tr class="Quadro-ou-Tabela"><td class="Quadro-ou-Tabela"><p class="Tabela" id="{ids.next("ParaDest-")}">{cell}</p></td></tr>')
+    return (
+        f'<table id="{ids.next("Table-")}" class="Quadro">'
+        '<thead><tr class="Quadro-ou-Tabela"><td><p class="Tabela-Titulo">QUADRO</p></td></tr></thead>'
+        f'<tbody>{"".join(body)}</tbody></table>'
+    )
+
+def activity(rng, number, ids):
+    enunciado = f'<p class="_c-Atividade-Enunciado" id="{ids.next("ParaDest-")}">{number}. {sentence(rng, 14)}</p>'
+    alternativas = "".join(
+        f'<p class="_b-Atividade-alternativa">{letter}) {sentence(rng, 6)}</p>' for letter in "ABCD"
+    )
+    return enunciado + alternativas + '<p class="_r-Atividade-Resposta">Resposta</p>'
+
+def answer_key(rng, count):
+    items = ['<h2 class="_1-Titulo-1">Respostas às atividades</h2>']
+    for number in range(1, count + 1):
+        items.append(f"<p>Atividade {number}</p>")
+        items.append(f"<p>Resposta: {rng.choice('ABCD')}</p>")
+        items.append(f"<p>Comentário: {sentence(rng, 15)}</p>")
+    items.append('<h2 class="_1-Titulo-1">Referências</h2>')
+    items.append(f"<p>{sentence(rng, 10)}</p>")
+    return "".join(items)
+
+def xhtml_file(rng, index, params, image_srcs, qr_srcs):
+    ids = IdGenerator()
+    parts = [f'<h2 class="_1-Titulo-1" id="{ids.next("TextAnchor")}">Capítulo {index + 1}</h2>']
+
+    blocks = []
+    blocks += [paragraph(rng, ids) for _ in range(params["paragraphs"])]
+    blocks += [figure(rng.choice(image_srcs), ids) for _ in range(params["figures"]) if image_srcs]
+    blocks += [table(rng, params["rows"], ids) for _ in range(params["tables"])]
+    if qr_srcs and rng.random() < 0.5:
+        blocks.append(figure(rng.choice(qr_srcs), ids))
+    if rng.random() < 0.2:
+        blocks.append(f'<ul><li><p>{sentence(rng, 5)}</p><h3>{sentence(rng, 3)}</h3></li></ul>')
+    rng.shuffle(blocks)
+    parts += blocks
+
+    parts += [activity(rng, number, ids) for number in range(1, params["activities"] + 1)]
+    if params["activities"]:
+        parts.append(answer_key(rng, params["activities"]))
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+        '<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="pt-BR" lang="pt-BR">\n'
+        f'<head>\n<meta charset="utf-8" />\n<title>Capítulo {index + 1}</title>\n'
+        '<link href="../Styles/idGeneratedStyles.css" rel="stylesheet" type="text/css" />\n</head>\n'
+        f'<body id="{ids.next("Body")}" lang="pt-BR" xml:lang="pt-BR">\n'
+        f'<div id="{ids.next("Container")}" class="Basic-Text-Frame">\n'
+        + "\n".join(parts) +
+        '\n</div>\n<div><div class="Basic-Text-Frame"></div></div>\n</body>\n</html>\n'
+    )
+
+def photo_bytes(rng, size):
+    """
+    A noisy RGB image standing for a photo or chart (not a QR candidate).
+    """
+    img = Image.new('RGB', size, (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randint(0, size[0]), rng.randint(0, size[1])
+        draw.ellipse([x, y, x + rng.randint(10, 120), y + rng.randint(10, 120)],
+                     fill=(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+def qr_bytes(rng, payload):
+    """
+    A real QR code if the qrcode package is installed, otherwise a QR-like
+    image (finder patterns and random modules) that decoders reject.
+    """
+    if qrcode is not None:
+        img = qrcode.make(payload).convert('L')
+    else:
+        modules = 29
+        scale = 8
+        img = Image.new('L', ((modules + 8) * scale,) * 2, 255)
+        draw = ImageDraw.Draw(img)
+        for row in range(modules):
+            for col in range(modules):
+                if rng.random() < 0.5:
+                    x, y = (col + 4) * scale, (row + 4) * scale
+                    draw.rectangle([x, y, x + scale - 1, y + scale - 1], fill=0)
+        for fx, fy in ((0, 0), (modules - 7, 0), (0, modules - 7)):
+            x, y = (fx + 4) * scale, (fy + 4) * scale
+            draw.rectangle([x, y, x + 7 * scale - 1, y + 7 * scale - 1], fill=0)
+            draw.rectangle([x + scale, y + scale, x + 6 * scale - 1, y + 6 * scale - 1], fill=255)
+            draw.rectangle([x + 2 * scale, y + 2 * scale, x + 5 * scale - 1, y + 5 * scale - 1], fill=0)
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def generate_epub(path, files=10, paragraphs=30, figures=2, tables=1, rows=8, activities=2,
+                  qr_images=2, photos=None, image_size=(800, 600), seed=42):
+    """
+    Writes a synthetic ePub to path and returns path.
+    """
+    rng = random.Random(seed)
+    photos = photos if photos is not None else max(1, files // 2)
+    params = {"paragraphs": paragraphs, "figures": figures, "tables": tables, "rows": rows, "activities": activities}
+
+    image_srcs = [f"../Image/foto{i:03d}.jpg" for i in range(photos)]
+    qr_srcs = [f"../Image/QR{i:03d}.png" for i in range(qr_images)]
+
+    manifest = []
+    spine = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml',
+                      '<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                      '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+                      '</container>')
+        epub.writestr('OEBPS/Styles/idGeneratedStyles.css', 'p._1-Corpo-de-texto { margin: 0; }\n')
+        manifest.append('<item id="css" href="Styles/idGeneratedStyles.css" media-type="text/css"/>')
+
+        for i in range(files):
+            name = f"Text/capitulo{i:03d}.xhtml"
+            epub.writestr(f"OEBPS/{name}", xhtml_file(rng, i, params, image_srcs, qr_srcs))
+            manifest.append(f'<item id="cap{i:03d}" href="{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="cap{i:03d}"/>')
+
+        for i, src in enumerate(image_srcs):
+            epub.writestr(f"OEBPS/{src[3:]}", photo_bytes(rng, image_size))
+            manifest.append(f'<item id="foto{i:03d}" href="{src[3:]}" media-type="image/jpeg"/>')
+
+        for i, src in enumerate(qr_srcs):
+            epub.writestr(f"OEBPS/{src[3:]}", qr_bytes(rng, f"https://portal.example.com/link/?l={i:08x}"))
+            manifest.append(f'<item id="qr{i:03d}" href="{src[3:]}" media-type="image/png"/>')
+
+        epub.writestr('OEBPS/content.opf',
+                      '<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">'
+                      '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                      f'<dc:identifier id="bookid">urn:uuid:synthetic-{seed}-{files}</dc:identifier>'
+                      f'<dc:title>Synthetic book ({files} files)</dc:title><dc:language>pt-BR</dc:language>'
+                      '</metadata>'
+                      f'<manifest>{"".join(manifest)}</manifest>'
+                      f'<spine>{"".join(spine)}</spine>'
+                      '</package>')
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic ePub for benchmarks")
+    parser.add_argument("output", help="Path of the generated ePub")
+    parser.add_argument("--size", choices=SIZES.keys(), help="Preset corpus size")
+    parser.add_argument("--files", type=int, help="Number of XHTML files")
+    parser.add_argument("--paragraphs", type=int, help="Paragraphs per file")
+    parser.add_argument("--figures", type=int, help="Inline-Figure images per file")
+    parser.add_argument("--tables", type=int, help="Quadro-ou-Tabela tables per file")
+    parser.add_argument("--rows", type=int, help="Rows per table")
+    parser.add_argument("--activities", type=int, help="Activities (with answer key) per file")
+    parser.add_argument("--qr-images", type=int, help="Number of QR code images")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    params = dict(SIZES[args.size]) if args.size else {}
+    for key in ("files", "paragraphs", "figures", "tables", "rows", "activities", "qr_images"):
+        value = getattr(args, key)
+        if value is not None:
+            params[key] = value
+
+    generate_epub(args.output, seed=args.seed, **params)
+    print(f"Generated {args.output} ({os.path.getsize(args.output)} bytes)")
+
+if __name__ == "__main__":
+    main()
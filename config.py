@@ -10,6 +10,43 @@ class Config:
     AI_API_KEY = os.getenv("AI_API_KEY", "")
     AI_MODEL = os.getenv("AI_MODEL", "local-model")
     AI_PROVIDER = os.getenv("AI_PROVIDER", "lm-studio")
+    # Maximum number of AI requests in flight at once for a book
+    AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", 4))
+    # Estimated prompt tokens per request when packing several small tables together (0 = one table per request)
+    AI_BATCH_TOKENS = int(os.getenv("AI_BATCH_TOKENS", 0))
+    # Seconds the AI stage of one book may take (0 = no limit)
+    AI_BOOK_DEADLINE = float(os.getenv("AI_BOOK_DEADLINE", 0))
+    # Consecutive failed AI requests that stop further calls, and seconds before a probe request is tried
+    AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", 3))
+    AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", 30))
+    # Stream AI answers and close the stream as soon as the JSON answer is complete
+    AI_STREAM = os.getenv("AI_STREAM", "0").lower() in ("1", "true", "yes")
+    # Ask for JSON schema constrained answers (opt-in): "0" (default), "1", or "auto" (providers known to support it)
+    AI_STRUCTURED_OUTPUT = os.getenv("AI_STRUCTURED_OUTPUT", "0").lower()
+    # max_tokens allowed on top of the answer size, for models that reason before answering (opt-in, 0 = none)
+    AI_REASONING_TOKENS = int(os.getenv("AI_REASONING_TOKENS", 0))
+    
+    # Processing Configuration
+    # Books up to this uncompressed size (bytes) are processed in memory, larger ones are extracted to disk
+    IN_MEMORY_MAX_SIZE = int(os.getenv("IN_MEMORY_MAX_SIZE", 512 * 1024 * 1024))
+    # Folder of the persistent caches (processed books, ...)
+    CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+    # Processed books cached in CACHE_DIR take at most this many MB; the least recently used go past the limit
+    BOOK_CACHE_MAX_SIZE_MB = int(os.getenv("BOOK_CACHE_MAX_SIZE_MB", 2048))
+    # AI answers cached in CACHE_DIR expire after this many days; the least recently used go past the entry limit
+    AI_CACHE_MAX_AGE_DAYS = float(os.getenv("AI_CACHE_MAX_AGE_DAYS", 90))
+    AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", 100000))
+    # QR decoding results cached in CACHE_DIR (one per distinct image); the least recently used go past the limit
+    QR_CACHE_MAX_ENTRIES = int(os.getenv("QR_CACHE_MAX_ENTRIES", 200000))
+    # Processes decoding QR images (0 = the --workers count of the book) and images each one decodes
+    # before it is replaced (0 = never; replacing workers makes the pool start them with spawn)
+    QR_WORKERS = int(os.getenv("QR_WORKERS", 0))
+    QR_MAX_TASKS_PER_CHILD = int(os.getenv("QR_MAX_TASKS_PER_CHILD", 0))
+    # Only scan referenced images that pass the cheap QR checks, and decode large JPEGs at a reduced size (pixels)
+    QR_PRESCREEN = os.getenv("QR_PRESCREEN", "1").lower() in ("1", "true", "yes")
+    QR_MAX_DECODE_SIZE = int(os.getenv("QR_MAX_DECODE_SIZE", 1600))
+    # Parser of the XHTML documents: "html.parser", "lxml" (lxml HTML parser) or "xhtml" (lxml XML parser, for well-formed XHTML)
+    HTML_PARSER = os.getenv("HTML_PARSER", "html.parser").lower()
     
     # Cleaning Patterns
     # Note: Split into list to avoid variable-length lookbehind errors in Python re module.
@@ -5,8 +5,16 @@ import shutil
 import logging
 import glob
 import time
+import signal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from config import Config
-from utils.epub_wrapper import extract_epub, package_epub
+from utils.epub_wrapper import open_book
+from utils.document_store import DocumentStore
+from utils.parallel import FileExecutor
+from utils.book_cache import BookCache
+from utils.profiler import Profiler
+from utils.watcher import FolderWatcher, move_processed
 from modules import renamer, cleaner, structure, interactivity, topic_identifier, ncx_generator, auditor, url_linker, qr_scanner, font_injector
 
 def setup_logging():
@@ -19,70 +27,175 @@ def setup_logging():
         ]
     )
 
-def process_file(input_path, output_path, enable_url_linker=True):
+def setup_worker_logging(log_path):
+    """
+    Sends the log of a batch job to its own file so parallel workers
+    don't interleave their output in the shared epub_automation.log.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(log_path)],
+        force=True
+    )
+
+def build_output_path(input_path, output_arg):
+    filename = os.path.basename(input_path)
+    # If output is a directory, generate output filename
+    if os.path.isdir(output_arg):
+        name, ext = os.path.splitext(filename)
+        return os.path.join(output_arg, f"{name}_v2{ext}")
+    return output_arg
+
+def process_file(input_path, output_path, enable_url_linker=True, qr_report_path=None, workers=1, in_memory=True, use_cache=True,
+                 enable_ai=True, ai_concurrency=None, ai_refresh=False, topic_rules=True, ai_batch_tokens=None,
+                 ai_deadline=None, ai_deadline_at=None, ai_stream=None, qr_workers=None,
+                 profile=False, profile_dir="profiles", cprofile=False):
+    """
+    Runs the whole pipeline on one ePub.
+    With workers > 1 the file-local stages run on a per-file process pool.
+    With in_memory the book is processed without extracting it to a temp directory.
+    With use_cache an unchanged book is copied from the book cache instead of reprocessed.
+    ai_concurrency caps the AI requests in flight for the book (default: Config.AI_CONCURRENCY).
+    AI answers and QR decoding results are cached with use_cache too; ai_refresh asks the AI again and overwrites them.
+    With topic_rules, clear-cut tables are classified locally instead of by the AI.
+    ai_batch_tokens packs small tables into shared AI requests (default: Config.AI_BATCH_TOKENS).
+    The AI stage stops sending requests after ai_deadline seconds (default: Config.AI_BOOK_DEADLINE)
+    or at ai_deadline_at, the time.time() deadline of the whole batch; the tables left
+    are listed in the result and the output is not cached.
+    qr_workers is the number of processes decoding QR images (default: Config.QR_WORKERS,
+    or workers when that is 0).
+    With ai_stream (default: Config.AI_STREAM) AI answers are streamed and each request
+    ends as soon as its JSON answer is complete.
+    With profile a JSON report of per-stage and per-file timings is written to profile_dir
+    (profiling always reprocesses the book, so the cache is bypassed).
+    Returns a dict with the book timings, AI metrics and error (if any).
+    """
     start_single = time.time()
     logging.info(f"Starting processing: {input_path} -> {output_path}")
 
-    # Temporary work directory
+    if qr_report_path is None:
+        qr_report_path = os.path.join(os.getcwd(), "qr_code_report.txt")
+
+    result = {
+        "book": os.path.basename(input_path),
+        "ok": False,
+        "time": 0,
+        "ai_time": 0,
+        "ai_wall": 0,
+        "ai_calls": 0,
+        "ai_cache_hits": 0,
+        "rule_decisions": 0,
+        "ai_skipped": [],
+        "tokens": 0,
+        "cleaning_hits": {},
+        "cached": False,
+        "error": None
+    }
+
+    if ai_batch_tokens is None:
+        ai_batch_tokens = Config.AI_BATCH_TOKENS
+
+    cache = BookCache() if use_cache and not profile else None
+    if cache:
+        cache_key = cache.key(input_path, {"enable_url_linker": enable_url_linker, "enable_ai": enable_ai, "topic_rules": topic_rules, "ai_batch_tokens": ai_batch_tokens,
+                                           "ai_stream": Config.AI_STREAM if ai_stream is None else ai_stream})
+        # A refresh has to reach the AI stage, so it never reads the book cache
+        if not ai_refresh and cache.get(cache_key, output_path, qr_report_path):
+            logging.info(f"Cache hit for {input_path}. Copied cached output to {output_path}")
+            result["ok"] = True
+            result["cached"] = True
+            result["time"] = time.time() - start_single
+            print(f"\nProcessed {os.path.basename(input_path)} in {result['time']:.2f}s (cached)")
+            return result
+
+    # Temporary work directory (only used when the book is extracted to disk)
     work_dir = os.path.join(os.path.dirname(output_path), f"temp_epub_{os.path.basename(input_path)}")
-    if os.path.exists(work_dir):
-        shutil.rmtree(work_dir)
-    os.makedirs(work_dir)
 
-    ai_metrics = {"total_ai_time": 0, "total_tokens": 0, "ai_calls": 0}
+    ai_metrics = {"total_ai_time": 0, "total_tokens": 0, "ai_calls": 0, "wall_time": 0, "cache_hits": 0, "cache_misses": 0, "tables": 0, "rule_decisions": 0, "skipped_tables": []}
+    book_name = os.path.splitext(os.path.basename(input_path))[0]
+    profiler = Profiler(book_name, enabled=profile, report_dir=profile_dir, cprofile=cprofile)
+    executor = FileExecutor(workers, profiler) if workers > 1 else None
+    book = None
 
     try:
-        # 0. Extract
-        opf_path, content_dir = extract_epub(input_path, work_dir)
-        logging.info(f"Extracted to {content_dir}, OPF: {opf_path}")
+        # 0. Open (in memory or extracted)
+        with profiler.stage("open"):
+            book = open_book(input_path, work_dir, in_memory)
+            logging.info(f"Opened {input_path} ({book.mode} mode), OPF: {book.opf_path}, files: {book.index.summary()}")
+
+            # Every stage shares the parsed documents of this store
+            store = DocumentStore(book, profiler)
 
         # AUDIT START
-        start_stats = auditor.count_elements(content_dir, "BEFORE")
+        with profiler.stage("audit_before"):
+            start_stats = auditor.count_elements(store, "BEFORE", executor)
 
         # 1. Rename Files (Skipped as per current logic)
         logging.info("Renaming skipped.")
 
         # 2. Cleaner
-        pre_clean_size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(content_dir) for f in files)
-        cleaner.run(content_dir)
-        post_clean_size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(content_dir) for f in files)
-        logging.info(f"Cleaning completed. Size change: {pre_clean_size} -> {post_clean_size} bytes")
+        with profiler.stage("cleaner"):
+            pre_clean_size = store.size()
+            result["cleaning_hits"] = cleaner.run(store, executor)
+            post_clean_size = store.size()
+            logging.info(f"Cleaning completed. Size change: {pre_clean_size} -> {post_clean_size} bytes")
         
         # 2.5. QR Scanner
-        qr_scanner.run(content_dir, os.getcwd())
+        with profiler.stage("qr_scanner"):
+            qr_codes = qr_scanner.run(store, qr_report_path, use_cache, qr_workers or Config.QR_WORKERS or workers)
 
         # 3. Structural Changes (Images)
-        structure.run(content_dir)
-        logging.info("Structure updates completed.")
+        with profiler.stage("structure"):
+            structure.run(store, executor)
+            logging.info("Structure updates completed.")
 
         # 3.5. Inject Fonts
-        font_injector.run(content_dir, opf_path)
-        logging.info("Fonts injected.")
+        with profiler.stage("font_injector"):
+            font_injector.run(book)
+            logging.info("Fonts injected.")
 
         # 4. Interactivity (Plugin Logic)
-        interactivity.run(content_dir, opf_path)
-        logging.info("Interactivity injected.")
+        with profiler.stage("interactivity"):
+            interactivity.run(store)
+            logging.info("Interactivity injected.")
 
         # 4.5. URL Linker
         if enable_url_linker:
-            url_linker.run(content_dir)
-            logging.info("URL linking completed.")
+            with profiler.stage("url_linker"):
+                url_linker.run(store, executor)
+                logging.info("URL linking completed.")
 
         # 5. Topic Identifier (AI)
-        ai_metrics = topic_identifier.run(content_dir)
-        logging.info("Topic identification completed.")
+        if enable_ai:
+            with profiler.stage("topic_identifier"):
+                deadline = ai_deadline_at
+                if ai_deadline is None:
+                    ai_deadline = Config.AI_BOOK_DEADLINE
+                if ai_deadline:
+                    deadline = min(filter(None, [deadline, time.time() + ai_deadline]))
+                ai_metrics = topic_identifier.run(store, ai_concurrency, use_cache, ai_refresh, topic_rules, ai_batch_tokens, deadline, ai_stream)
+                logging.info("Topic identification completed.")
 
         # 6. NCX Generator
-        ncx_generator.run(content_dir, opf_path)
-        logging.info("NCX updated.")
+        with profiler.stage("ncx_generator"):
+            ncx_generator.run(book)
+            logging.info("NCX updated.")
 
         # AUDIT END
-        end_stats = auditor.count_elements(content_dir, "AFTER")
-        auditor.compare(start_stats, end_stats)
+        with profiler.stage("audit_after"):
+            end_stats = auditor.count_elements(store, "AFTER", executor)
+            auditor.compare(start_stats, end_stats)
 
-        # 7. Package
-        package_epub(work_dir, output_path)
-        logging.info(f"Successfully created: {output_path}")
+        # 7. Package (each modified document is serialized once here)
+        with profiler.stage("package"):
+            store.flush()
+            book.package(output_path)
+            logging.info(f"Successfully created: {output_path}")
+
+        # Books with tables the AI didn't answer are not cached, so a re-run asks again
+        if cache and not ai_metrics["skipped_tables"]:
+            cache.put(cache_key, output_path, qr_report_path if qr_codes else None)
 
         end_single = time.time()
         total_time = end_single - start_single
@@ -90,14 +203,184 @@ def process_file(input_path, output_path, enable_url_linker=True):
         print(f"\nProcessed {os.path.basename(input_path)} in {total_time:.2f}s")
         if ai_metrics["ai_calls"] > 0:
             avg_ai = ai_metrics["total_ai_time"] / ai_metrics["ai_calls"]
-            print(f"AI Stage: {ai_metrics['total_ai_time']:.2f}s (Avg: {avg_ai:.2f}s, Tokens: {ai_metrics['total_tokens']})")
+            print(f"AI Stage: {ai_metrics['wall_time']:.2f}s wall, {ai_metrics['total_ai_time']:.2f}s in calls (Avg: {avg_ai:.2f}s, Tokens: {ai_metrics['total_tokens']})")
+        if ai_metrics["cache_hits"] > 0:
+            print(f"AI Cache: {ai_metrics['cache_hits']} hits, {ai_metrics['cache_misses']} misses")
+        if ai_metrics["tables"] > 0:
+            print(f"Tables: {ai_metrics['tables']} (rules: {ai_metrics['rule_decisions']}, AI cache: {ai_metrics['cache_hits']}, AI calls: {ai_metrics['ai_calls']})")
+        if ai_metrics["skipped_tables"]:
+            print(f"AI skipped {len(ai_metrics['skipped_tables'])} tables (re-run the book to retry them):")
+            for table in ai_metrics["skipped_tables"]:
+                print(f"  {table['file']} table {table['table']} (id={table['table_id']}) '{table['first_row']}': {table['reason']}")
+
+        result["ok"] = True
+        result["ai_time"] = ai_metrics["total_ai_time"]
+        result["ai_wall"] = ai_metrics["wall_time"]
+        result["ai_calls"] = ai_metrics["ai_calls"]
+        result["ai_cache_hits"] = ai_metrics["cache_hits"]
+        result["rule_decisions"] = ai_metrics["rule_decisions"]
+        result["ai_skipped"] = ai_metrics["skipped_tables"]
+        result["tokens"] = ai_metrics["total_tokens"]
 
     except Exception as e:
         logging.error(f"Error processing {input_path}: {e}", exc_info=True)
+        result["error"] = str(e)
     finally:
+        if executor:
+            executor.shutdown()
+        if book:
+            book.close()
         if os.path.exists(work_dir):
             shutil.rmtree(work_dir)
 
+    if profile:
+        result["profile"] = profiler.write_report()
+
+    result["time"] = time.time() - start_single
+    return result
+
+def process_batch_job(input_path, output_path, log_dir, options):
+    """
+    Entry point of a batch worker process.
+    Each book gets its own log file and QR report inside log_dir.
+    options are the keyword arguments passed to process_file.
+    """
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    setup_worker_logging(os.path.join(log_dir, f"{name}.log"))
+    qr_report_path = os.path.join(log_dir, f"{name}_qr_code_report.txt")
+    return process_file(input_path, output_path, qr_report_path=qr_report_path, **options)
+
+def run_batch(files_to_process, output_arg, jobs, log_dir, options):
+    """
+    Processes several books on a process pool.
+    Jobs are submitted largest input first so the slow books don't end up
+    running alone at the end of the batch.
+    """
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    ordered = sorted(files_to_process, key=os.path.getsize, reverse=True)
+    logging.info(f"Batch mode: {len(ordered)} files on {jobs} workers. Logs and QR reports in {log_dir}")
+
+    start_batch = time.time()
+    results = []
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(process_batch_job, input_path, build_output_path(input_path, output_arg), log_dir, options): input_path
+            for input_path in ordered
+        }
+        for future in as_completed(futures):
+            results.append(collect_result(future, futures[future]))
+
+    print_batch_summary(results, time.time() - start_batch)
+    return results
+
+def collect_result(future, input_path):
+    """
+    Returns the result dict of a finished batch job and logs its status.
+    """
+    try:
+        result = future.result()
+    except Exception as e:
+        # The worker itself died (e.g. out of memory), not the pipeline
+        result = {"book": os.path.basename(input_path), "ok": False, "time": 0, "ai_time": 0, "ai_wall": 0, "ai_calls": 0, "tokens": 0, "error": str(e)}
+    status = "CACHED" if result.get("cached") else "OK" if result["ok"] else "FAILED"
+    logging.info(f"[{status}] {result['book']} in {result['time']:.2f}s")
+    return result
+
+def run_watch(input_dir, output_arg, jobs, log_dir, options, poll_interval=1.0, settle_time=2.0, done_dir=None, failed_dir=None):
+    """
+    Daemon mode: keeps polling input_dir and processes every ePub dropped there
+    once it has finished being copied. The worker pool stays up between books,
+    so each new book skips the interpreter start and module imports.
+    Processed inputs are moved to done_dir or failed_dir. On Ctrl+C the running
+    books are finished and the queued ones stay in input_dir for the next start.
+    If a worker process dies, the books of the broken pool are moved to failed_dir
+    and a new pool is started.
+    """
+    done_dir = done_dir or os.path.join(input_dir, "done")
+    failed_dir = failed_dir or os.path.join(input_dir, "failed")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    watcher = FolderWatcher(input_dir, settle_time=settle_time)
+    running = {}
+    logging.info(f"Watching {input_dir} every {poll_interval}s with {jobs} workers. Press Ctrl+C to stop.")
+
+    def new_executor():
+        # Workers ignore Ctrl+C so the daemon decides what happens to the books in flight
+        return ProcessPoolExecutor(max_workers=jobs, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+
+    def restart_executor():
+        nonlocal executor
+        logging.error("A worker process died, restarting the worker pool.")
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = new_executor()
+
+    def submit(input_path):
+        # A broken pool refuses new work: it is replaced on the next submission
+        args = (process_batch_job, input_path, build_output_path(input_path, output_arg), log_dir, options)
+        try:
+            future = executor.submit(*args)
+        except BrokenProcessPool:
+            restart_executor()
+            future = executor.submit(*args)
+        running[future] = input_path
+
+    def finish(future):
+        input_path = running.pop(future)
+        # A dead worker fails every book of its pool with BrokenProcessPool, which
+        # collect_result reports as a failure: they go to failed_dir too
+        result = collect_result(future, input_path)
+        move_processed(input_path, done_dir if result["ok"] else failed_dir)
+        watcher.done(input_path)
+
+    executor = new_executor()
+    try:
+        while True:
+            for input_path in watcher.poll():
+                logging.info(f"Queued {input_path}")
+                submit(input_path)
+
+            for future in [f for f in running if f.done()]:
+                finish(future)
+
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        # Queued books stay in input_dir; the ones already running are finished
+        for future in [f for f in running if f.cancel()]:
+            running.pop(future)
+        logging.info(f"Stopping watch mode, waiting for {len(running)} running books. Press Ctrl+C again to abort.")
+        for future in as_completed(list(running)):
+            finish(future)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def print_batch_summary(results, wall_time):
+    failures = [r for r in results if not r["ok"]]
+    total_ai = sum(r["ai_time"] for r in results)
+    total_books = sum(r["time"] for r in results)
+
+    print("\n=== BATCH SUMMARY ===")
+    for r in sorted(results, key=lambda r: r["time"], reverse=True):
+        status = "CACHED" if r.get("cached") else "OK" if r["ok"] else "FAILED"
+        print(f"{r['book']:<50} {r['time']:>8.2f}s  AI: {r['ai_time']:>7.2f}s ({r['ai_calls']} calls)  {status}")
+    cached = sum(1 for r in results if r.get("cached"))
+    print(f"\nBooks: {len(results)}, Cached: {cached}, Failures: {len(failures)}")
+    print(f"Wall time: {wall_time:.2f}s, Sum of book times: {total_books:.2f}s, AI time: {total_ai:.2f}s")
+    for r in failures:
+        print(f"  FAILED {r['book']}: {r['error']}")
+    # Rules that matched nothing in the whole batch are candidates for removal from Config
+    processed = [r for r in results if r.get("cleaning_hits")]
+    if processed:
+        unused = [rule for rule in processed[0]["cleaning_hits"] if not any(r["cleaning_hits"].get(rule) for r in processed)]
+        if unused:
+            print(f"Cleaning rules without matches in any book: {', '.join(unused)}")
+    for r in results:
+        for table in r.get("ai_skipped", []):
+            print(f"  AI SKIPPED {r['book']}: {table['file']} table {table['table']} (id={table['table_id']}) '{table['first_row']}': {table['reason']}")
+
 def main():
     setup_logging()
     
@@ -105,10 +388,51 @@ def main():
     parser.add_argument("--input", help="Path to input ePub or directory (default: input/)")
     parser.add_argument("--output", help="Path to output ePub or directory (default: output/)")
     parser.add_argument("--nolinks", action="store_true", help="Disable URL linking")
+    parser.add_argument("--noai", action="store_true", help="Skip the AI topic identification stage")
+    parser.add_argument("--ai-concurrency", type=int, help="Maximum AI requests in flight per book (default: AI_CONCURRENCY, 4)")
+    parser.add_argument("--ai-refresh", action="store_true", help="Ignore cached AI answers and overwrite them (e.g. after a prompt change)")
+    parser.add_argument("--no-topic-rules", action="store_true", help="Send every table to the AI instead of deciding clear-cut tables locally")
+    parser.add_argument("--ai-batch-tokens", type=int, help="Pack small tables into one AI request up to this many estimated prompt tokens (default: AI_BATCH_TOKENS, 0 = off)")
+    parser.add_argument("--ai-deadline", type=float, help="Seconds the AI stage of each book may take (default: AI_BOOK_DEADLINE, 0 = no limit)")
+    parser.add_argument("--ai-batch-deadline", type=float, help="Seconds from start after which no book sends AI requests")
+    parser.add_argument("--ai-stream", action="store_true", help="Stream AI answers and stop each request once the JSON answer is complete (default: AI_STREAM)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of books processed in parallel (default: 1)")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used for the file-local stages of a single book (default: 1)")
+    parser.add_argument("--qr-workers", type=int, help="Processes decoding QR images (default: QR_WORKERS, or --workers)")
+    parser.add_argument("--extract", action="store_true", help="Extract books to a temp directory instead of processing them in memory")
+    parser.add_argument("--no-cache", action="store_true", help="Always reprocess books, without reading or writing the book, AI and QR caches")
+    parser.add_argument("--clear-cache", action="store_true", help="Purge the book cache before processing")
+    parser.add_argument("--profile", action="store_true", help="Write a JSON report with wall/CPU time and peak memory per stage and per file")
+    parser.add_argument("--profile-dir", default="profiles", help="Folder of the profile reports (default: profiles/)")
+    parser.add_argument("--cprofile", action="store_true", help="With --profile, also dump one cProfile file per stage")
+    parser.add_argument("--log-dir", default="logs", help="Per-book logs and QR reports in batch mode (default: logs/)")
+    parser.add_argument("--watch", action="store_true", help="Keep running and process every ePub dropped in the input folder")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between input folder scans in watch mode (default: 1)")
+    parser.add_argument("--settle-time", type=float, default=2.0, help="Seconds a file's size must stay unchanged before it is processed in watch mode (default: 2)")
     
     args = parser.parse_args()
 
-    enable_url_linker = not args.nolinks
+    options = {
+        "enable_url_linker": not args.nolinks,
+        "enable_ai": not args.noai,
+        "ai_concurrency": args.ai_concurrency,
+        "ai_refresh": args.ai_refresh,
+        "topic_rules": not args.no_topic_rules,
+        "ai_batch_tokens": args.ai_batch_tokens,
+        "ai_deadline": args.ai_deadline,
+        "ai_deadline_at": time.time() + args.ai_batch_deadline if args.ai_batch_deadline else None,
+        "ai_stream": args.ai_stream or None,
+        "workers": args.workers,
+        "qr_workers": args.qr_workers,
+        "in_memory": not args.extract,
+        "use_cache": not args.no_cache,
+        "profile": args.profile,
+        "profile_dir": args.profile_dir,
+        "cprofile": args.cprofile
+    }
+
+    if args.clear_cache:
+        BookCache().clear()
     
     input_arg = args.input or "input"
     output_arg = args.output or "output"
@@ -121,6 +445,13 @@ def main():
         os.makedirs(output_arg)
         logging.info(f"Created output directory: {output_arg}")
 
+    if args.watch:
+        if os.path.isfile(input_arg):
+            logging.error("--watch needs an input directory, not a file.")
+            return
+        run_watch(input_arg, output_arg, max(1, args.jobs), args.log_dir, options, args.poll_interval, args.settle_time)
+        return
+
     files_to_process = []
     
     if os.path.isfile(input_arg):
@@ -134,16 +465,13 @@ def main():
 
     logging.info(f"Found {len(files_to_process)} files to process.")
 
+    if args.jobs > 1 and len(files_to_process) > 1:
+        run_batch(files_to_process, output_arg, args.jobs, args.log_dir, options)
+        return
+
     for input_path in files_to_process:
-        filename = os.path.basename(input_path)
-        # If output is a directory, generate output filename
-        if os.path.isdir(output_arg):
-            name, ext = os.path.splitext(filename)
-            output_path = os.path.join(output_arg, f"{name}_v2{ext}")
-        else:
-            output_path = output_arg
-            
-        process_file(input_path, output_path, enable_url_linker)
+        output_path = build_output_path(input_path, output_arg)
+        process_file(input_path, output_path, **options)
 
 if __name__ == "__main__":
     main()
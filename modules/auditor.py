@@ -1,13 +1,24 @@
-import os
 import logging
-from bs4 import BeautifulSoup
+from utils.markup import parse
+from utils.element_index import ElementIndex
 
-def count_elements(content_dir, label):
-    """
-    Scans all XHTML files and counts: p, img, table, tr, li, Atividade.
-    Returns a dict with totals.
-    """
-    stats = {
+# Generated text signatures to ignore in the final count
+GENERATED_TEXTS = [
+    "Confira aqui a resposta",
+    "Resposta correta.",
+    "Resposta incorreta. A alternativa correta é a", 
+    "A alternativa correta é a"
+]
+
+# Generated classes to ignore in P count (injected by interactivity.py)
+GENERATED_CLASSES = [
+    '_1-Corpo-Comentario',
+    '_1-Corpo-Resposta',
+    '_r-Atividade-Resposta' # The button label p has this class
+]
+
+def new_stats():
+    return {
         'p': 0,
         'img': 0,
         'table': 0,
@@ -16,72 +27,76 @@ def count_elements(content_dir, label):
         'li': 0,
         'activity': 0
     }
+
+def count_soup(soup, stats, index=None):
+    """
+    Adds the element counts of one parsed document to stats.
+    index is the ElementIndex of the document, built here if not given.
+    """
+    index = index or ElementIndex(soup)
     
-    # Generated text signatures to ignore in the final count
-    generated_texts = [
-        "Confira aqui a resposta",
-        "Resposta correta.",
-        "Resposta incorreta. A alternativa correta é a", 
-        "A alternativa correta é a"
-    ]
-    
-    # Generated classes to ignore in P count (injected by interactivity.py)
-    generated_classes = [
-        '_1-Corpo-Comentario',
-        '_1-Corpo-Resposta',
-        '_r-Atividade-Resposta' # The button label p has this class
-    ]
+    # Simple Counts
+    stats['img'] += len(index.tags('img'))
+    stats['table'] += len(index.tags('table'))
+    stats['tr'] += len(index.tags('tr'))
+    stats['input'] += len(index.tags('input'))
+    stats['li'] += len(index.tags('li'))
     
-    logging.info(f"[{label}] Auditing content elements...")
+    # Count logical Activities
+    stats['activity'] += len(index.with_class('_c-Atividade-Enunciado'))
     
-    for root, _, files in os.walk(content_dir):
-        for file in files:
-            if not (file.endswith('.xhtml') or file.endswith('.html')):
-                continue
-                
-            file_path = os.path.join(root, file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Simple Counts
-            stats['img'] += len(soup.find_all('img'))
-            stats['table'] += len(soup.find_all('table'))
-            stats['tr'] += len(soup.find_all('tr'))
-            stats['input'] += len(soup.find_all('input'))
-            stats['li'] += len(soup.find_all('li'))
-            
-            # Count logical Activities
-            stats['activity'] += len(soup.find_all(class_='_c-Atividade-Enunciado'))
-            
-            # Paragraphs need strict filtering for the "After" stage
-            paragraphs = soup.find_all('p')
-            for p in paragraphs:
-                text = p.get_text().strip()
-                classes = p.get('class', [])
-                
-                # Check for generated content
-                is_generated = False
+    # Paragraphs need strict filtering for the "After" stage
+    paragraphs = index.tags('p')
+    for p in paragraphs:
+        text = p.get_text().strip()
+        classes = p.get('class', [])
+        
+        # Check for generated content
+        is_generated = False
+        
+        # Filter by Class
+        for gen_cls in GENERATED_CLASSES:
+            if gen_cls in classes:
+                is_generated = True
+                break
                 
-                # Filter by Class
-                for gen_cls in generated_classes:
-                    if gen_cls in classes:
-                        is_generated = True
-                        break
-                        
-                if is_generated:
-                    continue
+        if is_generated:
+            continue
+
+        # Filter by Text Start (Safety fallback)
+        for gen_text in GENERATED_TEXTS:
+            if text.startswith(gen_text):
+                is_generated = True
+                break
+        
+        if not is_generated:
+            stats['p'] += 1
+    
+    return stats
+
+def count_file(content):
+    """
+    Per-file task for the parallel executor. Never modifies the document.
+    """
+    return None, count_soup(parse(content), new_stats())
 
-                # Filter by Text Start (Safety fallback)
-                for gen_text in generated_texts:
-                    if text.startswith(gen_text):
-                        is_generated = True
-                        break
+def count_elements(store, label, executor=None):
+    """
+    Scans all XHTML files and counts: p, img, table, tr, li, Atividade.
+    Returns a dict with totals.
+    """
+    stats = new_stats()
+    
+    logging.info(f"[{label}] Auditing content elements...")
+    
+    if executor:
+        for file_stats in executor.map_documents(count_file, store.untimed()):
+            for key, value in file_stats.items():
+                stats[key] += value
+    else:
+        for doc in store:
+            count_soup(doc.soup, stats, doc.index)
                 
-                if not is_generated:
-                    stats['p'] += 1
-                    
     logging.info(f"[{label}] Stats: {stats}")
     return stats
 
@@ -1,8 +1,45 @@
-import os
 import re
 import logging
-from bs4 import BeautifulSoup
+from utils.markup import parse
 from config import Config
+from utils.rule_engine import RemovalRules
+from utils.transform import TreeTransform
+
+# Spots where invert_attributes may have work: an id="..." directly followed by a class="...".
+# Spelled out instead of IGNORECASE (with the other letters IGNORECASE matches), which would
+# make sre test every position of the text
+ID_CLASS = re.compile(r'[iIİı][dD]="[^"]*"\s+[cC][lL][aA][sSſ][sSſ]="')
+
+# The id/class swap, only ever matched from the '<' that can start it (see invert_attributes)
+INVERT_ID_CLASS = re.compile(r'(<[^>]+)\s+(id="[^"]*")(\s+)(class="[^"]*")', re.IGNORECASE)
+
+# Passes after the removal patterns
+EMPTY_DIVS = re.compile(r'<div>\s*<div class="Basic-Text-Frame"></div>\s*</div>')
+
+# Pre-scan of the BeautifulSoup step: without a list item and a header it has nothing to move
+HEADER = re.compile(r'<h[1-6][\s>/]')
+
+# Rule names of the hit counters, besides the REGEX_REMOVE_PATTERNS themselves
+RULE_INVERT_ATTRIBUTES = "invert_attributes"
+RULE_H1_IN_LISTS = "REGEX_H1_UL_FIX"
+RULE_EMPTY_DIVS = "empty_divs"
+
+# Compiled once per process (see get_rules)
+_rules = None
+_h1_regex = None
+
+def get_rules():
+    """
+    Returns the RemovalRules of Config.REGEX_REMOVE_PATTERNS and the compiled H1 pattern.
+    """
+    global _rules, _h1_regex
+    if _rules is None:
+        _rules = RemovalRules(Config.REGEX_REMOVE_PATTERNS)
+        try:
+            _h1_regex = re.compile(Config.REGEX_H1_UL_FIX['pattern'], re.DOTALL)
+        except re.error as e:
+            logging.warning(f"Error compiling H1 list cleaning pattern: {e}")
+    return _rules, _h1_regex
 
 def invert_attributes(html_content):
     """
@@ -10,99 +47,193 @@ def invert_attributes(html_content):
     Ensures 'class' comes *before* 'id' to satisfy the strict regex requirements.
     
     Target: <tag ... id="..." class="..." ...> -> <tag ... class="..." id="..." ...>
+    Returns (content, number of tags changed).
     """
-    # Regex to capture:
-    # Group 1: opening of tag and potential other attributes matching [^>]*
-    # Group 2: id attribute
-    # Group 3: whitespace/intervening chars
-    # Group 4: class attribute
-    # Note: This is a robust-enough approximation for standard XML/HTML.
-    
-    pattern = re.compile(r'(<[^>]+)\s+(id="[^"]*")(\s+)(class="[^"]*")', re.IGNORECASE)
-    
-    # Replacement: Group 1 + whitespace + Group 4 (class) + Group 3 + Group 2 (id)
-    # We add a space after Group 1 just in case, but usually \s+ handles it.
-    
-    return pattern.sub(r'\1 \4\3\2', html_content)
+    # Same output as INVERT_ID_CLASS.sub(r'\1 \4\3\2', html_content), including its quirks
+    # (a '>' inside a value before the pair stops it, comments are not skipped), without
+    # trying the pattern from every '<': only the first '<' after the last '>' before an
+    # id/class pair can start a match reaching it. The text in between is copied as is.
+    pieces = []
+    position = 0
+    for spot in ID_CLASS.finditer(html_content):
+        if spot.start() < position:
+            # Part of the previous match
+            continue
+        start = html_content.find('<', max(position, html_content.rfind('>', position, spot.start()) + 1), spot.start())
+        while start != -1:
+            match = INVERT_ID_CLASS.match(html_content, start)
+            if match:
+                pieces.append(html_content[position:start])
+                pieces.append(match.expand(r'\1 \4\3\2'))
+                position = match.end()
+                break
+            start = html_content.find('<', start + 1, spot.start())
+
+    if not pieces:
+        return html_content, 0
+    pieces.append(html_content[position:])
+    return ''.join(pieces), len(pieces) // 2
 
-def clean_h1_in_lists(content, pattern_info):
+def clean_h1_in_lists(content, regex):
     """
     Removes h1/h2 tags nested inside lists (ul/ol) which is invalid/messy HTML.
-    Uses the pattern from config.
+    Uses the compiled pattern from config.
+    Returns (content, number of replacements).
     """
-    regex = pattern_info['pattern']
+    if regex is None:
+        return content, 0
     # The users regex uses backreferences \1 to match content.
     # We try to apply it safely.
     
     try:
         # Note: Users regex: <h2 ...>(.*?)</h2></li>...</ul>...\1</h2>
         # This implies it pulls the content out of the list and reconstructs the h2.
-        return re.sub(regex, r'<h2 class="_1-Titulo-1">\1</h2>', content, flags=re.DOTALL)
+        return regex.subn(r'<h2 class="_1-Titulo-1">\1</h2>', content)
     except Exception as e:
         logging.warning(f"Error applying H1 list cleaning: {e}")
-        return content
+        return content, 0
 
-def move_headers_out_of_lists(soup):
+def move_header_out_of_list(h):
+    """
+    Moves a header nested inside an <li> after its parent list (ul/ol).
+    Returns True if the header was moved.
+    """
+    li_parent = h.find_parent('li')
+    if not li_parent:
+        return False
+    # Find the root list container (ul or ol)
+    list_container = li_parent.find_parent(['ul', 'ol'])
+    if not list_container:
+        return False
+    # Move the header after the list container
+    h_extract = h.extract()
+    list_container.insert_after(h_extract)
+    logging.info(f"Moved header '{h_extract.get_text()[:20]}...' out of list.")
+    return True
+
+HEADERS = TreeTransform()
+
+@HEADERS.rule('h1')
+@HEADERS.rule('h2')
+@HEADERS.rule('h3')
+@HEADERS.rule('h4')
+@HEADERS.rule('h5')
+@HEADERS.rule('h6')
+def header_in_list(h, ancestors, deferred):
+    if any(ancestor.name == 'li' for ancestor in ancestors):
+        # Moved after the walk, in document order, as the earlier moves leave the tree
+        deferred.append(lambda: move_header_out_of_list(h))
+    return False
+
+def move_headers_out_of_lists(soup, index=None):
     """
     Finds header tags (h1-h6) nested inside <li> tags and moves them 
     outside the parent list (ul/ol).
     """
-    modified = False
-    # Find all h1, h2, h3, h4, h5, h6 tags
-    headers = soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+    return HEADERS.apply(soup, index)
+
+def may_nest_headers(text):
+    """
+    Pre-scan gate of move_headers_out_of_lists.
+    """
+    return '<li' in text and HEADER.search(text) is not None
+
+def new_hits():
+    """
+    Hit counters of the cleaning rules: [invert_attributes, *REGEX_REMOVE_PATTERNS, H1 fix, empty divs].
+    """
+    return [0] * (len(Config.REGEX_REMOVE_PATTERNS) + 3)
+
+def rule_names():
+    return [RULE_INVERT_ATTRIBUTES] + list(Config.REGEX_REMOVE_PATTERNS) + [RULE_H1_IN_LISTS, RULE_EMPTY_DIVS]
+
+def clean_text(content, hits=None):
+    """
+    Applies the text (regex) cleaning steps to a document.
+    Adds the matches of each rule to hits (see new_hits) when given.
+    """
+    hits = hits if hits is not None else new_hits()
+    rules, h1_regex = get_rules()
+
+    # 1. Attribute Normalization (Class before ID)
+    content, swaps = invert_attributes(content)
+    hits[0] += swaps
+    
+    # 2. General Regex Cleaning (from Config), combined into as few passes as possible
+    removal_hits = [0] * len(rules.patterns)
+    content = rules.apply(content, removal_hits)
+    for i, count in enumerate(removal_hits, 1):
+        hits[i] += count
+        
+    # 3. H1 inside Lists
+    content, replaced = clean_h1_in_lists(content, h1_regex)
+    hits[-2] += replaced
     
-    for h in headers:
-        # Check if the header is inside an li
-        li_parent = h.find_parent('li')
-        if li_parent:
-            # Found a nested header. We need to move it out of the list.
-            # Usually it's at the end of the li, but let's be safe.
-            
-            # Find the root list container (ul or ol)
-            list_container = li_parent.find_parent(['ul', 'ol'])
-            if list_container:
-                # Move the header after the list container
-                h_extract = h.extract()
-                list_container.insert_after(h_extract)
-                modified = True
-                logging.info(f"Moved header '{h_extract.get_text()[:20]}...' out of list.")
-                
-    return modified
-
-def run(content_dir):
-    logging.info(f"Cleaning files in {content_dir}...")
+    # 4. Remove Empty Divs
+    # Pattern: <div>\s*<div class="Basic-Text-Frame"></div>\s*</div>
+    content, removed = EMPTY_DIVS.subn('', content)
+    hits[-1] += removed
     
-    for root, _, files in os.walk(content_dir):
-        for file in files:
-            if file.endswith('.xhtml') or file.endswith('.html'):
-                file_path = os.path.join(root, file)
-                
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                original_content = content
-                
-                # 1. Attribute Normalization (Class before ID)
-                content = invert_attributes(content)
-                
-                # 2. General Regex Cleaning (from Config)
-                for pattern in Config.REGEX_REMOVE_PATTERNS:
-                    # Replace with empty string
-                    content = re.sub(pattern, '', content)
-                    
-                # 3. H1 inside Lists
-                content = clean_h1_in_lists(content, Config.REGEX_H1_UL_FIX)
-                
-                # 4. Remove Empty Divs
-                # Pattern: <div>\s*<div class="Basic-Text-Frame"></div>\s*</div>
-                content = re.sub(r'<div>\s*<div class="Basic-Text-Frame"></div>\s*</div>', '', content)
-                
-                # 5. Fix Nested Headers using BeautifulSoup
-                soup = BeautifulSoup(content, 'html.parser')
-                if move_headers_out_of_lists(soup):
-                    content = str(soup)
-
-                if content != original_content:
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(content)
-                    logging.debug(f"Cleaned {file}")
+    return content
+
+def clean_file(content):
+    """
+    Per-file task for the parallel executor.
+    Returns (new_text or None if unchanged, (modified flag, rule hits, parsed flag)).
+    """
+    hits = new_hits()
+    cleaned = clean_text(content, hits)
+    parsed = may_nest_headers(cleaned)
+    if parsed:
+        soup = parse(cleaned)
+        if move_headers_out_of_lists(soup):
+            cleaned = str(soup)
+    if cleaned == content:
+        return None, (False, hits, parsed)
+    return cleaned, (True, hits, parsed)
+
+def log_hits(hits):
+    """
+    Logs the matches of every cleaning rule in the book, so rules that never match can be spotted.
+    """
+    logging.info("Cleaning rule hits:")
+    for name, count in zip(rule_names(), hits):
+        logging.info(f"  {count:6d}  {name}")
+    unused = [name for name, count in zip(rule_names(), hits) if not count]
+    if unused:
+        logging.info(f"Cleaning rules without matches in this book: {len(unused)}")
+
+def run(store, executor=None):
+    """
+    Cleans every document. Returns {rule: number of matches in the book}.
+    """
+    logging.info(f"Cleaning files in {store.content_dir}...")
+    hits = new_hits()
+    
+    if executor:
+        results = executor.map_documents(clean_file, store.untimed())
+        for _, file_hits, _ in results:
+            hits = [a + b for a, b in zip(hits, file_hits)]
+        logging.info(f"Cleaned {sum(modified for modified, _, _ in results)} files in parallel.")
+        skipped = sum(not parsed for _, _, parsed in results)
+        logging.info(f"Header fix: skipped {skipped} of {len(results)} files (pre-scan).")
+        log_hits(hits)
+        return dict(zip(rule_names(), hits))
+    
+    skipped = 0
+    for doc in store:
+        # Only replaces (and invalidates the parsed tree) if the text changed
+        doc.text = clean_text(doc.text, hits)
+        
+        # 5. Fix Nested Headers using BeautifulSoup (shared tree)
+        if not may_nest_headers(doc.text):
+            skipped += 1
+        elif move_headers_out_of_lists(doc.soup, doc.index):
+            doc.mark_modified()
+
+        if doc.modified:
+            logging.debug(f"Cleaned {doc.name}")
+
+    logging.info(f"Header fix: skipped {skipped} of {len(store)} files (pre-scan).")
+    log_hits(hits)
+    return dict(zip(rule_names(), hits))
@@ -1,9 +1,9 @@
 import os
-import shutil
+import posixpath
 import logging
 from bs4 import BeautifulSoup
 
-def run(content_dir, opf_path):
+def run(book):
     """
     Injects fonts from assets/fonts into the EPUB and updates the OPF manifest.
     """
@@ -12,24 +12,21 @@ def run(content_dir, opf_path):
     # 1. Define paths
     # assets/fonts is at the root of the project
     assets_fonts_dir = os.path.join(os.getcwd(), 'assets', 'fonts')
-    # target fonts dir in the extracted EPUB content dir
-    target_fonts_dir = os.path.join(content_dir, 'Fonts')
+    # target fonts dir in the EPUB content dir
+    target_fonts_dir = posixpath.join(book.content_dir, 'Fonts')
     
     if not os.path.exists(assets_fonts_dir):
         logging.warning(f"Assets fonts directory not found: {assets_fonts_dir}")
         return
 
-    if not os.path.exists(target_fonts_dir):
-        os.makedirs(target_fonts_dir)
-        logging.info(f"Created directory: {target_fonts_dir}")
-
     # 2. Copy fonts
     fonts_copied = []
     for font_file in os.listdir(assets_fonts_dir):
         if font_file.lower().endswith(('.ttf', '.otf', '.woff', '.woff2')):
             src = os.path.join(assets_fonts_dir, font_file)
-            dst = os.path.join(target_fonts_dir, font_file)
-            shutil.copy2(src, dst)
+            dst = posixpath.join(target_fonts_dir, font_file)
+            with open(src, 'rb') as f:
+                book.write_bytes(dst, f.read())
             fonts_copied.append(font_file)
             logging.debug(f"Copied font: {font_file}")
 
@@ -39,15 +36,18 @@ def run(content_dir, opf_path):
 
     logging.info(f"Copied {len(fonts_copied)} fonts to {target_fonts_dir}")
 
-    # 3. Update OPF Manifest
-    update_opf_manifest(opf_path, fonts_copied)
+    # 3. Update OPF Manifest (only parsed when some font is not listed yet)
+    missing_fonts = [f for f in fonts_copied if not book.index.in_manifest(posixpath.join(target_fonts_dir, f))]
+    if not missing_fonts:
+        logging.info("All fonts already in manifest.")
+        return
+    update_opf_manifest(book, missing_fonts)
 
-def update_opf_manifest(opf_path, fonts_copied):
+def update_opf_manifest(book, fonts_copied):
     """
     Adds copied fonts to the <manifest> in the OPF file.
     """
-    with open(opf_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    content = book.read_text(book.opf_path)
 
     soup = BeautifulSoup(content, 'xml') # Use xml parser for OPF
     manifest = soup.find('manifest')
@@ -96,6 +96,5 @@ def update_opf_manifest(opf_path, fonts_copied):
         logging.info(f"Added {font_file} to manifest.")
 
     if modified:
-        with open(opf_path, 'w', encoding='utf-8') as f:
-            f.write(str(soup))
+        book.write_text(book.opf_path, str(soup))
         logging.info("OPF manifest updated with new fonts.")
@@ -1,10 +1,11 @@
 import os
 import re
 import logging
+import posixpath
 import unicodedata
-import shutil
 from bs4 import BeautifulSoup
 from config import Config
+from utils.element_index import ElementIndex
 
 JS_BLOCK = """
 <script type='text/javascript'>
@@ -82,55 +83,34 @@ def clean_html_content(tag_html):
     except:
         return tag_html
 
-def find_tags_with_class(soup, class_name):
-    tags = []
-    # Using CSS selector is often more robust in bs4 if supported
-    # but stick to logic from plugin for consistency
-    for tag in soup.find_all(True):
-        try:
-            classes = tag.get('class')
-        except:
-            classes = None
-        if not classes:
-            continue
-        if isinstance(classes, (list, tuple)):
-            if class_name in classes:
-                tags.append(tag)
-        else:
-            if class_name == classes or class_name in classes:
-                tags.append(tag)
-    return tags
-
-def inject_jquery_asset(content_dir):
-    js_dir = os.path.join(content_dir, "js")
-    if not os.path.exists(js_dir):
-        os.makedirs(js_dir)
+def inject_jquery_asset(book):
+    js_dir = posixpath.join(book.content_dir, "js")
     
     # Source asset path (assuming assets folder in project root)
     # This module is in modules/, so root is ../
     project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     src_jquery = os.path.join(project_root, "assets", "jquery.min.js")
     
-    dst_jquery = os.path.join(js_dir, "jquery.min.js")
+    dst_jquery = posixpath.join(js_dir, "jquery.min.js")
     
     if os.path.exists(src_jquery):
-        shutil.copy(src_jquery, dst_jquery)
+        with open(src_jquery, 'rb') as f:
+            book.write_bytes(dst_jquery, f.read())
         logging.info(f"Copied jquery.min.js to {dst_jquery}")
     else:
         logging.warning(f"jquery.min.js not found at {src_jquery}. Creating empty placeholder to avoid crash, but functionality will fail.")
         # Create dummy file if missing to prevent file-not-found later? 
         # Better to error out or user needs to fix.
-        with open(dst_jquery, 'w') as f:
-            f.write("// jQuery placeholder")
+        book.write_text(dst_jquery, "// jQuery placeholder")
 
-def update_opf_manifest(opf_path, modified_files):
+def update_opf_manifest(book, modified_files):
+    opf_path = book.opf_path
     logging.info(f"Updating OPF manifest at {opf_path}")
-    if not os.path.exists(opf_path):
+    if not book.exists(opf_path):
         logging.error("OPF path invalid.")
         return
 
-    with open(opf_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    content = book.read_text(opf_path)
     
     # Try parsing as xml, fallback to html.parser
     try:
@@ -155,12 +135,18 @@ def update_opf_manifest(opf_path, modified_files):
         logging.info("Added jquery item to manifest.")
 
     # 2. Add scripted property to modified files
-    opf_dir = os.path.dirname(opf_path)
+    opf_dir = book.content_dir or '.'
+    items_by_href = {}
+    for item in manifest.find_all('item'):
+        items_by_href.setdefault(item.get('href'), item)
+
     for file_path in modified_files:
+        if not book.index.in_manifest(file_path):
+            continue
         # Calculate relative path from OPF to the file
-        rel_path = os.path.relpath(file_path, opf_dir).replace(os.sep, '/')
+        rel_path = posixpath.relpath(file_path, opf_dir)
         
-        item = manifest.find('item', href=rel_path)
+        item = items_by_href.get(rel_path)
         if item:
             props = item.get('properties', '')
             if 'scripted' not in props:
@@ -168,257 +154,283 @@ def update_opf_manifest(opf_path, modified_files):
                 item['properties'] = new_props
                 # logging.info(f"Added scripted property to {rel_path}")
 
-    with open(opf_path, 'w', encoding='utf-8') as f:
-        f.write(str(soup))
+    book.write_text(opf_path, str(soup))
 
 
-def run(content_dir, opf_path):
-    logging.info(f"Injecting interactivity in {content_dir}...")
+def add_activities(soup, index=None):
+    """
+    Adds the answer interactions after the activity statements of a parsed document.
+    index is the ElementIndex of the document, built here if not given.
+    Returns True if the tree was modified.
+    """
+    modified = False
+    index = index or ElementIndex(soup)
     
-    # Ensure jQuery is physically present
-    inject_jquery_asset(content_dir)
-
-    modified_files = []
-
-    for root, _, files in os.walk(content_dir):
-        for file in files:
-            if not (file.endswith('.xhtml') or file.endswith('.html')):
-                continue
-                
-            file_path = os.path.join(root, file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # --- LOGIC PORTED FROM PLUGIN.PY ---
+    # --- LOGIC PORTED FROM PLUGIN.PY ---
+    
+    gabarito_map = {}
+    current_activity = None
+    found_gabarito_header = False
+    
+    # Find all potential relevant tags
+    all_elements = index.tags('p', 'div', 'h1', 'h2', 'h3', 'h4', 'li', 'span')
+    to_remove = []
+    
+    # Pass 1: Build Gabarito Map
+    for el in all_elements:
+        text_pure = normalize_text(el.get_text())
+        norm_for_match = strip_accents(text_pure).lower()
+        
+        # Check for Gabarito Header
+        if el.name in ['h1', 'h2', 'h3', 'h4'] and re.search(r"\b(respostas?\s.*atividades|atividades\s.*respostas?)\b", norm_for_match):
+            found_gabarito_header = True
             
-            gabarito_map = {}
-            current_activity = None
-            found_gabarito_header = False
+        if found_gabarito_header:
+            to_remove.append(el)
             
-            # Find all potential relevant tags
-            all_elements = soup.find_all(['p', 'div', 'h1', 'h2', 'h3', 'h4', 'li', 'span'])
-            to_remove = []
+        # Stop removal if we hit References/Bibliography
+        if el.name in ['h1', 'h2', 'h3', 'h4']:
+            if re.search(r'^(referencias|referencia|bibliografia|leitura)', norm_for_match):
+                current_activity = None
+                if el in to_remove: to_remove.remove(el)
+                found_gabarito_header = False
+                continue
+        
+        # Identify Activity Number
+        act_match = re.match(r'^Atividade[:\s]*0*(\d+)', text_pure, re.IGNORECASE)
+        if act_match:
+            current_activity = act_match.group(1)
+            if current_activity not in gabarito_map:
+                gabarito_map[current_activity] = {'resposta': '', 'comentario': ''}
+        elif current_activity:
+            # Capture Response/Comment
+            try:
+                inner_html = el.decode_contents()
+            except:
+                inner_html = el.get_text()
+                
+            if re.match(r'^Resposta:|^Resposta\b', text_pure, re.IGNORECASE):
+                gabarito_map[current_activity]['resposta'] = clean_html_content(inner_html)
+            elif re.match(r'^Comentário:|^Comentário\b', text_pure, re.IGNORECASE):
+                gabarito_map[current_activity]['comentario'] = clean_html_content(inner_html)
+            elif gabarito_map[current_activity]['comentario'] and not re.match(r'^Atividade', text_pure, re.IGNORECASE):
+                gabarito_map[current_activity]['comentario'] += ' ' + inner_html.strip()
+
+    # Note: We do NOT decompose the gabarito tags as per the original script comment:
+    # "Não decompor (remover) as tags do gabarito"
+    
+    # Pass 2: Apply Interactivity to Enunciados
+    enunciados = index.with_class("_c-Atividade-Enunciado")
+    
+    for enunciado in enunciados:
+        text_enunciado = normalize_text(enunciado.get_text())
+        match_num = re.match(r'^0*(\d+)[\.\)]', text_enunciado)
+        
+        if match_num:
+            num = match_num.group(1)
+            dados = gabarito_map.get(num)
             
-            # Pass 1: Build Gabarito Map
-            for el in all_elements:
-                text_pure = normalize_text(el.get_text())
-                norm_for_match = strip_accents(text_pure).lower()
+            if dados:
+                # IDs
+                idE = "opc" + num + "E"
+                idC = "opc" + num + "C"
+                idR = "opc" + num + "R"
+                idD = "opc" + num + "D"
                 
-                # Check for Gabarito Header
-                if el.name in ['h1', 'h2', 'h3', 'h4'] and re.search(r"\b(respostas?\s.*atividades|atividades\s.*respostas?)\b", norm_for_match):
-                    found_gabarito_header = True
-                    
-                if found_gabarito_header:
-                    to_remove.append(el)
-                    
-                # Stop removal if we hit References/Bibliography
-                if el.name in ['h1', 'h2', 'h3', 'h4']:
-                    if re.search(r'^(referencias|referencia|bibliografia|leitura)', norm_for_match):
-                        current_activity = None
-                        if el in to_remove: to_remove.remove(el)
-                        found_gabarito_header = False
-                        continue
+                current = enunciado.find_next_sibling()
+                is_multipla = False
                 
-                # Identify Activity Number
-                act_match = re.match(r'^Atividade[:\s]*0*(\d+)', text_pure, re.IGNORECASE)
-                if act_match:
-                    current_activity = act_match.group(1)
-                    if current_activity not in gabarito_map:
-                        gabarito_map[current_activity] = {'resposta': '', 'comentario': ''}
-                elif current_activity:
-                    # Capture Response/Comment
-                    try:
-                        inner_html = el.decode_contents()
-                    except:
-                        inner_html = el.get_text()
+                while current:
+                    if isinstance(current, str) or current.name is None:
+                        current = current.find_next_sibling()
+                        continue
                         
-                    if re.match(r'^Resposta:|^Resposta\b', text_pure, re.IGNORECASE):
-                        gabarito_map[current_activity]['resposta'] = clean_html_content(inner_html)
-                    elif re.match(r'^Comentário:|^Comentário\b', text_pure, re.IGNORECASE):
-                        gabarito_map[current_activity]['comentario'] = clean_html_content(inner_html)
-                    elif gabarito_map[current_activity]['comentario'] and not re.match(r'^Atividade', text_pure, re.IGNORECASE):
-                        gabarito_map[current_activity]['comentario'] += ' ' + inner_html.strip()
-
-            # Note: We do NOT decompose the gabarito tags as per the original script comment:
-            # "Não decompor (remover) as tags do gabarito"
-            
-            # Pass 2: Apply Interactivity to Enunciados
-            enunciados = find_tags_with_class(soup, "_c-Atividade-Enunciado")
-            
-            for enunciado in enunciados:
-                text_enunciado = normalize_text(enunciado.get_text())
-                match_num = re.match(r'^0*(\d+)[\.\)]', text_enunciado)
-                
-                if match_num:
-                    num = match_num.group(1)
-                    dados = gabarito_map.get(num)
+                    classes = current.get('class', [])
                     
-                    if dados:
-                        # IDs
-                        idE = "opc" + num + "E"
-                        idC = "opc" + num + "C"
-                        idR = "opc" + num + "R"
-                        idD = "opc" + num + "D"
+                    # Multiple Choice Interaction
+                    if '_b-Atividade-alternativa' in classes:
+                        is_multipla = True
+                        alt_text = normalize_text(current.get_text())
+                        letra_match = re.match(r'^([A-Da-d])[\)\.]', alt_text)
                         
-                        current = enunciado.find_next_sibling()
-                        is_multipla = False
-                        
-                        while current:
-                            if isinstance(current, str) or current.name is None:
-                                current = current.find_next_sibling()
-                                continue
-                                
-                            classes = current.get('class', [])
+                        if letra_match:
+                            letra = letra_match.group(1).lower()
+                            # Extract correct letter from response HTML
+                            resp_soup_temp = BeautifulSoup(dados['resposta'], 'html.parser')
+                            letra_correta_raw = resp_soup_temp.get_text().strip()
+                            letra_correta = letra_correta_raw[0].lower() if letra_correta_raw else ""
                             
-                            # Multiple Choice Interaction
-                            if '_b-Atividade-alternativa' in classes:
-                                is_multipla = True
-                                alt_text = normalize_text(current.get_text())
-                                letra_match = re.match(r'^([A-Da-d])[\)\.]', alt_text)
-                                
-                                if letra_match:
-                                    letra = letra_match.group(1).lower()
-                                    # Extract correct letter from response HTML
-                                    resp_soup_temp = BeautifulSoup(dados['resposta'], 'html.parser')
-                                    letra_correta_raw = resp_soup_temp.get_text().strip()
-                                    letra_correta = letra_correta_raw[0].lower() if letra_correta_raw else ""
-                                    
-                                    is_correct = (letra == letra_correta)
-                                    onclick = f"showMe('{idC}', '{idE}', '{idR}', '{idD}')" if is_correct else f"showMe('{idE}', '{idC}', '{idR}', '{idD}')"
-                                    
-                                    if not current.find('input'):
-                                        new_radio = soup.new_tag('input')
-                                        new_radio['type'] = "radio"
-                                        new_radio['name'] = "opc"+num
-                                        new_radio['value'] = letra
-                                        new_radio['onclick'] = onclick
-                                        current.insert(0, new_radio)
+                            is_correct = (letra == letra_correta)
+                            onclick = f"showMe('{idC}', '{idE}', '{idR}', '{idD}')" if is_correct else f"showMe('{idE}', '{idC}', '{idR}', '{idD}')"
                             
-                            # Answer Button and Feedback Divs
-                            if '_r-Atividade-Resposta' in classes:
-                                # Create Button
-                                div_btn = soup.new_tag('div', id=idR)
-                                div_btn['onclick'] = f"showMe('{idD}', '{idE}', '{idR}', '{idC}')"
-                                p_btn = soup.new_tag('p')
-                                p_btn['class'] = '_r-Atividade-Resposta'
-                                p_btn.string = "Confira aqui a resposta"
-                                div_btn.append(p_btn)
-                                
-                                # Prepare HTML contents
-                                com_html = BeautifulSoup(dados['comentario'], 'html.parser')
-                                res_html = BeautifulSoup(dados['resposta'], 'html.parser')
-
-                                # 1. Error Div
-                                div_erro = soup.new_tag('div')
-                                div_erro['class'] = 'questaoErrada'
-                                div_erro['id'] = idE
-                                if is_multipla:
-                                    p_res_inc = soup.new_tag('p')
-                                    p_res_inc['class'] = '_1-Corpo-Resposta'
-                                    p_res_inc.append('Resposta incorreta. A alternativa correta é a "')
-                                    p_res_inc.append(BeautifulSoup(str(res_html), 'html.parser'))
-                                    p_res_inc.append('".')
-                                    div_erro.append(p_res_inc)
-                                
-                                hr_tag = soup.new_tag('hr', **{'class': 'resposta'})
-                                div_erro.append(hr_tag)
-                                p_com_erro = soup.new_tag('p')
-                                p_com_erro['class'] = '_1-Corpo-Comentario'
-                                if com_html.get_text(strip=True):
-                                    p_com_erro.append(BeautifulSoup(str(com_html), 'html.parser'))
-
-                                div_erro.append(p_com_erro)
-
-                                # 2. Correct Div
-                                div_acerto = soup.new_tag('div')
-                                div_acerto['class'] = 'questaoCorreta'
-                                div_acerto['id'] = idC
-                                p_res_corr = soup.new_tag('p')
-                                p_res_corr['class'] = '_1-Corpo-Resposta'
-                                p_res_corr.string = "Resposta correta."
-                                div_acerto.append(p_res_corr)
-                                hr_tag = soup.new_tag('hr', **{'class': 'resposta'})
-                                div_acerto.append(hr_tag)
-                                p_com_acerto = soup.new_tag('p')
-                                p_com_acerto['class'] = '_1-Corpo-Comentario'
-                                if com_html.get_text(strip=True):
-                                    p_com_acerto.append(BeautifulSoup(str(com_html), 'html.parser'))
-
-                                div_acerto.append(p_com_acerto)
-
-                                # 3. Check Div
-                                div_confira = soup.new_tag('div')
-                                div_confira['class'] = 'questaoConfira'
-                                div_confira['id'] = idD
-                                if is_multipla:
-                                    p_res_conf = soup.new_tag('p')
-                                    p_res_conf['class'] = '_1-Corpo-Resposta'
-                                    p_res_conf.append('A alternativa correta é a "')
-                                    p_res_conf.append(BeautifulSoup(str(res_html), 'html.parser'))
-                                    p_res_conf.append('".')
-                                    div_confira.append(p_res_conf)
-                                    hr_tag = soup.new_tag('hr', **{'class': 'resposta'})
-                                    div_confira.append(hr_tag)
-                                    p_com_conf = soup.new_tag('p')
-                                    p_com_conf['class'] = '_1-Corpo-Comentario'
-                                    if com_html.get_text(strip=True):
-                                        p_com_conf.append(BeautifulSoup(str(com_html), 'html.parser'))
-
-                                    div_confira.append(p_com_conf)
-                                else:
-                                    if dados['resposta']:
-                                        p_diss = soup.new_tag('p')
-                                        p_diss['class'] = '_1-Corpo-Comentario'
-                                        p_diss.append(BeautifulSoup(str(res_html), 'html.parser'))
-                                        div_confira.append(p_diss)
-                                    if dados['comentario']:
-                                        p_diss_c = soup.new_tag('p')
-                                        p_diss_c['class'] = '_1-Corpo-Comentario'
-                                        if com_html.get_text(strip=True):
-                                            p_diss_c.append(BeautifulSoup(str(com_html), 'html.parser'))
-
-                                        div_confira.append(p_diss_c)
-
-                                # Insertion
-                                current.insert_before(div_btn)
-                                current.insert_before(div_erro)
-                                current.insert_before(div_acerto)
-                                current.insert_before(div_confira)
-                                
-                                to_delete = current
-                                current = current.find_next_sibling()
-                                to_delete.decompose()
-                                break
-                                
-                            current = current.find_next_sibling()
-
-            # Inject Script in Head
-            if soup.head:
-                if not soup.head.find(string=re.compile("showMe")):
-                    # Calculate relative path to jquery
-                    # content_dir/js/jquery.min.js
-                    # file_path is the current file
-                    
-                    # Target: content_dir/js/jquery.min.js
-                    # We need path from file_dir to target
+                            if not current.find('input'):
+                                new_radio = soup.new_tag('input')
+                                new_radio['type'] = "radio"
+                                new_radio['name'] = "opc"+num
+                                new_radio['value'] = letra
+                                new_radio['onclick'] = onclick
+                                current.insert(0, new_radio)
+                                modified = True
                     
-                    # Assume jquery is always in content_dir/js
-                    target_js = os.path.join(content_dir, "js", "jquery.min.js")
-                    rel_js_path = os.path.relpath(target_js, os.path.dirname(file_path)).replace(os.sep, '/')
-                    
-                    # 1. Inject jQuery script tag
-                    script_tag = soup.new_tag('script', src=rel_js_path, type="text/javascript")
-                    soup.head.append(script_tag)
-                    
-                    # 2. Inject the code block
-                    soup.head.append(BeautifulSoup(JS_BLOCK, 'html.parser'))
-                    
-                    modified_files.append(file_path)
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(str(soup))
+                    # Answer Button and Feedback Divs
+                    if '_r-Atividade-Resposta' in classes:
+                        # Create Button
+                        div_btn = soup.new_tag('div', id=idR)
+                        div_btn['onclick'] = f"showMe('{idD}', '{idE}', '{idR}', '{idC}')"
+                        p_btn = soup.new_tag('p')
+                        p_btn['class'] = '_r-Atividade-Resposta'
+                        p_btn.string = "Confira aqui a resposta"
+                        div_btn.append(p_btn)
+                        
+                        # Prepare HTML contents
+                        com_html = BeautifulSoup(dados['comentario'], 'html.parser')
+                        res_html = BeautifulSoup(dados['resposta'], 'html.parser')
+
+                        # 1. Error Div
+                        div_erro = soup.new_tag('div')
+                        div_erro['class'] = 'questaoErrada'
+                        div_erro['id'] = idE
+                        if is_multipla:
+                            p_res_inc = soup.new_tag('p')
+                            p_res_inc['class'] = '_1-Corpo-Resposta'
+                            p_res_inc.append('Resposta incorreta. A alternativa correta é a "')
+                            p_res_inc.append(BeautifulSoup(str(res_html), 'html.parser'))
+                            p_res_inc.append('".')
+                            div_erro.append(p_res_inc)
+                        
+                        hr_tag = soup.new_tag('hr', **{'class': 'resposta'})
+                        div_erro.append(hr_tag)
+                        p_com_erro = soup.new_tag('p')
+                        p_com_erro['class'] = '_1-Corpo-Comentario'
+                        if com_html.get_text(strip=True):
+                            p_com_erro.append(BeautifulSoup(str(com_html), 'html.parser'))
+
+                        div_erro.append(p_com_erro)
+
+                        # 2. Correct Div
+                        div_acerto = soup.new_tag('div')
+                        div_acerto['class'] = 'questaoCorreta'
+                        div_acerto['id'] = idC
+                        p_res_corr = soup.new_tag('p')
+                        p_res_corr['class'] = '_1-Corpo-Resposta'
+                        p_res_corr.string = "Resposta correta."
+                        div_acerto.append(p_res_corr)
+                        hr_tag = soup.new_tag('hr', **{'class': 'resposta'})
+                        div_acerto.append(hr_tag)
+                        p_com_acerto = soup.new_tag('p')
+                        p_com_acerto['class'] = '_1-Corpo-Comentario'
+                        if com_html.get_text(strip=True):
+                            p_com_acerto.append(BeautifulSoup(str(com_html), 'html.parser'))
+
+                        div_acerto.append(p_com_acerto)
+
+                        # 3. Check Div
+                        div_confira = soup.new_tag('div')
+                        div_confira['class'] = 'questaoConfira'
+                        div_confira['id'] = idD
+                        if is_multipla:
+                            p_res_conf = soup.new_tag('p')
+                            p_res_conf['class'] = '_1-Corpo-Resposta'
+                            p_res_conf.append('A alternativa correta é a "')
+                            p_res_conf.append(BeautifulSoup(str(res_html), 'html.parser'))
+                            p_res_conf.append('".')
+                            div_confira.append(p_res_conf)
+                            hr_tag = soup.new_tag('hr', **{'class': 'resposta'})
+                            div_confira.append(hr_tag)
+                            p_com_conf = soup.new_tag('p')
+                            p_com_conf['class'] = '_1-Corpo-Comentario'
+                            if com_html.get_text(strip=True):
+                                p_com_conf.append(BeautifulSoup(str(com_html), 'html.parser'))
+
+                            div_confira.append(p_com_conf)
+                        else:
+                            if dados['resposta']:
+                                p_diss = soup.new_tag('p')
+                                p_diss['class'] = '_1-Corpo-Comentario'
+                                p_diss.append(BeautifulSoup(str(res_html), 'html.parser'))
+                                div_confira.append(p_diss)
+                            if dados['comentario']:
+                                p_diss_c = soup.new_tag('p')
+                                p_diss_c['class'] = '_1-Corpo-Comentario'
+                                if com_html.get_text(strip=True):
+                                    p_diss_c.append(BeautifulSoup(str(com_html), 'html.parser'))
+
+                                div_confira.append(p_diss_c)
+
+                        # Insertion
+                        current.insert_before(div_btn)
+                        current.insert_before(div_erro)
+                        current.insert_before(div_acerto)
+                        current.insert_before(div_confira)
+                        
+                        to_delete = current
+                        current = current.find_next_sibling()
+                        to_delete.decompose()
+                        modified = True
+                        break
+                        
+                    current = current.find_next_sibling()
+
+    return modified
+
+def inject_head_scripts(soup, rel_js_path):
+    """
+    Appends the scripts to <head> unless already there.
+    Returns True if the tree was modified.
+    """
+    if not soup.head or soup.head.find(string=re.compile("showMe")):
+        return False
+    
+    # 1. Inject jQuery script tag
+    script_tag = soup.new_tag('script', src=rel_js_path, type="text/javascript")
+    soup.head.append(script_tag)
+    
+    # 2. Inject the code block
+    soup.head.append(BeautifulSoup(JS_BLOCK, 'html.parser'))
+    return True
+
+def may_have_activities(text):
+    """
+    Pre-scan gate of add_activities: interactions only go after activity statements.
+    """
+    return '_c-Atividade-Enunciado' in text
+
+def run(store):
+    content_dir = store.content_dir
+    logging.info(f"Injecting interactivity in {content_dir}...")
+    
+    # Ensure jQuery is physically present
+    inject_jquery_asset(store.book)
+
+    modified_files = []
+    skipped = 0
+
+    # Assume jquery is always in content_dir/js
+    target_js = posixpath.join(content_dir, "js", "jquery.min.js")
+
+    for doc in store:
+        file_path = doc.path
+        # Relative path from the current file to content_dir/js/jquery.min.js
+        rel_js_path = posixpath.relpath(target_js, posixpath.dirname(file_path) or '.')
+
+        # Every document gets the head scripts through the tree, so it is serialized
+        # the same way whether or not an earlier stage parsed it; only the
+        # activities walk is skipped
+        if may_have_activities(doc.snapshot):
+            modified = add_activities(doc.soup, doc.index)
+        else:
+            skipped += 1
+            modified = False
+
+        # Inject Script in Head
+        if inject_head_scripts(doc.soup, rel_js_path):
+            modified_files.append(file_path)
+            modified = True
+        
+        if modified:
+            doc.mark_modified()
+
+    logging.info(f"Interactivity: no activities in {skipped} of {len(store)} files (pre-scan).")
 
     # Update OPF with new requirements
-    update_opf_manifest(opf_path, modified_files)
+    update_opf_manifest(store.book, modified_files)
@@ -1,20 +1,20 @@
-import os
+import posixpath
 import logging
 from bs4 import BeautifulSoup
 
-def run(content_dir, opf_path):
+def run(book):
     """
     Generates a TOC.ncx for ePub based on the files in the OPF spine.
     Ensures the NCX identifier matches the OPF identifier.
     """
     logging.info("Updating/Generating NCX...")
     
-    if not os.path.exists(opf_path):
+    opf_path = book.opf_path
+    if not book.exists(opf_path):
         logging.error(f"OPF file not found at {opf_path}")
         return
 
-    with open(opf_path, 'r', encoding='utf-8') as f:
-        opf_soup = BeautifulSoup(f.read(), 'xml')
+    opf_soup = BeautifulSoup(book.read_text(opf_path), 'xml')
 
     # 1. Extract Identifier
     # The unique-identifier attribute in <package> points to the id of the <dc:identifier>
@@ -48,9 +48,9 @@ def run(content_dir, opf_path):
     existing_ncx_item = manifest.find('item', **{'media-type': 'application/x-dtbncx+xml'})
     if existing_ncx_item:
         href = existing_ncx_item.get('href')
-        ncx_path = os.path.join(os.path.dirname(opf_path), href)
+        ncx_path = posixpath.join(book.content_dir, href)
     else:
-        ncx_path = os.path.join(os.path.dirname(opf_path), 'toc.ncx')
+        ncx_path = posixpath.join(book.content_dir, 'toc.ncx')
         logging.info(f"NCX not found in manifest, using default path: {ncx_path}")
 
     # Build Spine list (ID -> Href)
@@ -84,7 +84,7 @@ def run(content_dir, opf_path):
         if not (href.endswith('.xhtml') or href.endswith('.html')):
             continue
 
-        label = os.path.basename(href).replace('.xhtml', '').replace('.html', '')
+        label = posixpath.basename(href).replace('.xhtml', '').replace('.html', '')
         
         ncx_content.append(f'    <navPoint id="navPoint-{play_order}" playOrder="{play_order}">')
         ncx_content.append(f'      <navLabel><text>{label}</text></navLabel>')
@@ -95,8 +95,7 @@ def run(content_dir, opf_path):
     ncx_content.append('  </navMap>')
     ncx_content.append('</ncx>')
     
-    with open(ncx_path, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(ncx_content))
+    book.write_text(ncx_path, '\n'.join(ncx_content))
     
     logging.info(f"NCX generated successfully with identifier: {book_id}")
 
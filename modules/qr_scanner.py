@@ -1,18 +1,225 @@
-import os
+import io
+import re
+import sys
+import itertools
+import html
+import signal
+import posixpath
 import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
 from pyzbar.pyzbar import decode
-from bs4 import BeautifulSoup
+from utils.epub_wrapper import normalize_path
+from utils.qr_cache import QRCache
+from config import Config
 
-def run(content_dir, project_root):
+try:
+    import numpy
+except ImportError:
+    # Without NumPy the pre-screen only checks the image size (see run)
+    numpy = None
+
+# Bump whenever the decoding below changes, so cached results are not reused
+DECODER_VERSION = 2
+
+# Image references read from the text without parsing it: src of the <img> tags,
+# href of the SVG <image> tags and url() in styles and stylesheets
+IMG_SRC = re.compile(r'<img\b[^>]*?\ssrc\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+SVG_IMAGE_HREF = re.compile(r'<(?:svg:)?image\b[^>]*?\s(?:xlink:)?href\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+CSS_URL = re.compile(r'url\(\s*(?:"([^"]*)"|\'([^\']*)\'|([^)\s]*))\s*\)', re.IGNORECASE)
+
+# Pre-screen thresholds: shortest side that can hold a QR code (version 1 at one
+# pixel per module), size the checks run at (large enough for a version 40 code
+# that fills a third of the image), largest share of mid-gray pixels, and
+# smallest number of finder pattern crossings in each direction
+MIN_QR_SIDE = 21
+SCREEN_SIZE = 1024
+MAX_GRAY_SHARE = 0.5
+MIN_FINDER_RUNS = 3
+
+def image_path_of(doc_path, src):
+    # Resolve src relative to the xhtml file
+    return normalize_path(posixpath.join(posixpath.dirname(doc_path), src))
+
+def _references(text, base_path, patterns, paths):
+    for pattern in patterns:
+        for match in pattern.finditer(text):
+            src = html.unescape(next((group for group in match.groups() if group is not None), ''))
+            if src and not src.startswith('data:'):
+                paths.add(image_path_of(base_path, src))
+
+def references_any(text, names):
+    """
+    Pre-scan gate of the QR linking: a document can only link the QR images whose
+    file names appear in its text.
+    """
+    return any(name in text for name in names)
+
+def referenced_images(store):
+    """
+    Returns the set of image paths referenced by the documents (<img src>, SVG
+    <image href>, url() in styles) and by the url() of the book stylesheets.
+    """
+    paths = set()
+    for doc in store:
+        _references(doc.text, doc.path, (IMG_SRC, SVG_IMAGE_HREF, CSS_URL), paths)
+    for css_path in store.book.content_files('css'):
+        _references(store.book.read_bytes(css_path).decode('utf-8', errors='replace'), css_path, (CSS_URL,), paths)
+    return paths
+
+def finder_runs(dark):
+    """
+    Counts the dark-light-dark-light-dark runs in 1:1:3:1:1 proportions along the
+    rows of a boolean image: the crossings of QR finder patterns, wherever the code
+    sits in the image.
+    """
+    height, width = dark.shape
+    # A light column after each row, so dark runs never continue on the next row
+    padded = numpy.zeros((height, width + 1), dtype=bool)
+    padded[:, :width] = dark
+    flat = padded.ravel()
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]))
+    starts = bounds[:-1]
+    lengths = numpy.diff(bounds).astype(float)
+    count = len(lengths) - 4
+    if count <= 0:
+        return 0
+    a, b, c, d, e = (lengths[k:k + count] for k in range(5))
+    module = (a + b + c + d + e) / 7
+    # Half a module of tolerance, plus half a pixel for the rounding of small codes
+    tolerance = module / 2 + 0.5
+    row = starts // (width + 1)
+    match = (flat[starts[:count]] & (row[:count] == row[4:])
+             & (abs(a - module) < tolerance) & (abs(b - module) < tolerance)
+             & (abs(d - module) < tolerance) & (abs(e - module) < tolerance)
+             & (abs(c - 3 * module) < 3 * module / 2 + 0.5))
+    return int(numpy.count_nonzero(match))
+
+def looks_like_qr(img):
+    """
+    Cheap checks run before pyzbar on a grayscale copy of at most SCREEN_SIZE pixels:
+    a QR code is mostly black and white, and its finder patterns are crossed in
+    1:1:3:1:1 runs both along the rows and the columns. Captions or text around
+    the code don't matter. Returns False for images that can't be QR codes
+    (photos, charts, gradients).
+    """
+    screen = img.convert('L')
+    screen.thumbnail((SCREEN_SIZE, SCREEN_SIZE))
+    gray = numpy.asarray(screen)
+
+    # Near-binary histogram
+    if numpy.count_nonzero((gray > 64) & (gray < 192)) > MAX_GRAY_SHARE * gray.size:
+        return False
+
+    dark = gray < 128
+    return finder_runs(dark) >= MIN_FINDER_RUNS and finder_runs(dark.T) >= MIN_FINDER_RUNS
+
+def decode_qr(data, prescreen=True):
+    """
+    Returns the payloads of the QR codes found in the image bytes (an empty list if none),
+    or None when the pre-screen rejected the image without running pyzbar.
+    Large JPEGs are decoded at a reduced scale (Config.QR_MAX_DECODE_SIZE).
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if prescreen and min(img.size) < MIN_QR_SIDE:
+            return None
+        if img.format == 'JPEG' and max(img.size) > Config.QR_MAX_DECODE_SIZE:
+            # Lets the JPEG decoder skip the full resolution
+            img.draft('L', (Config.QR_MAX_DECODE_SIZE, Config.QR_MAX_DECODE_SIZE))
+        if prescreen and numpy is not None and not looks_like_qr(img):
+            return None
+        return [obj.data.decode("utf-8") for obj in decode(img) if obj.type == 'QRCODE']
+
+def _decode_task(data, prescreen=True):
+    """
+    Runs decode_qr in a worker. Returns (payloads, None), or (None, error message).
+    """
+    try:
+        return decode_qr(data, prescreen), None
+    except Exception as e:
+        return None, str(e)
+
+def decode_images(images, workers=1, prescreen=True):
+    """
+    Decodes images, an iterable of (image path, image bytes) pairs, on a pool of
+    workers processes when there are several. images is consumed as the pool
+    makes room: at most 2 * workers images are in flight so memory stays bounded
+    on books with hundreds of large figures. With Config.QR_MAX_TASKS_PER_CHILD > 0
+    each worker is replaced after that many images.
+    If a worker dies (e.g. Pillow crashing on a corrupt image), the images in flight
+    get an error and the rest are decoded on a new pool.
+    Returns {image path: (payloads, error)}; payloads is None for rejected images.
+    """
+    images = iter(images)
+    first = list(itertools.islice(images, 2))
+    if workers <= 1 or len(first) < 2:
+        return {path: _decode_task(data, prescreen) for path, data in itertools.chain(first, images)}
+
+    logging.info(f"Decoding images on {workers} processes...")
+    options = {}
+    if Config.QR_MAX_TASKS_PER_CHILD > 0:
+        if sys.version_info >= (3, 11):
+            # The pool then starts its workers with spawn: each one re-imports the decoder instead of forking
+            options["max_tasks_per_child"] = Config.QR_MAX_TASKS_PER_CHILD
+            logging.info(f"QR workers are replaced every {Config.QR_MAX_TASKS_PER_CHILD} images (spawn start method: slower worker start).")
+        else:
+            logging.warning("QR_MAX_TASKS_PER_CHILD needs Python 3.11 or later: QR workers are not replaced.")
+
+    def new_pool():
+        # Workers leave Ctrl+C to the main process, which shuts the pool down
+        return ProcessPoolExecutor(max_workers=workers, initializer=signal.signal,
+                                   initargs=(signal.SIGINT, signal.SIG_IGN), **options)
+
+    def collect(futures):
+        for future in futures:
+            path = in_flight.pop(future)
+            try:
+                results[path] = future.result()
+            except BrokenProcessPool:
+                # Any of the images in flight may have killed the worker
+                results[path] = (None, "QR decoder process crashed")
+
+    pool = new_pool()
+    results = {}
+    in_flight = {}
+    try:
+        for path, data in itertools.chain(first, images):
+            if len(in_flight) >= 2 * workers:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            try:
+                future = pool.submit(_decode_task, data, prescreen)
+            except BrokenProcessPool:
+                collect(wait(in_flight).done)
+                logging.warning("A QR decoder process died: restarting the pool for the remaining images.")
+                pool.shutdown(cancel_futures=True)
+                pool = new_pool()
+                future = pool.submit(_decode_task, data, prescreen)
+            in_flight[future] = path
+        collect(wait(in_flight).done)
+    finally:
+        pool.shutdown(cancel_futures=True)
+    return results
+
+def run(store, report_path, use_cache=True, workers=1, prescreen=None):
     """
     Scans images in the content directory for QR codes,
     wraps them in <a> tags in XHTML files,
-    and creates a summary report in the project root.
+    and writes a summary report to report_path.
+    Returns the number of QR codes in the report (0 when none was written).
+    With use_cache, the results (including "no QR code") are read from and saved
+    to the QR cache by image content hash and decode size, so a repeated image is
+    not decoded again. Images rejected by the pre-screen are not cached, so a run
+    without it still scans them.
+    With workers > 1 the images are decoded on a process pool (see decode_images).
+    With prescreen (Config.QR_PRESCREEN by default) only the images referenced by
+    the documents or stylesheets are scanned, and looks_like_qr rejects the ones
+    that can't be QR codes before pyzbar runs.
     """
-    logging.info(f"Scanning for QR codes in {content_dir}...")
+    book = store.book
+    logging.info(f"Scanning for QR codes in {store.content_dir}...")
 
-    # Mapping of absolute image path to its QR content
+    # Mapping of image path (inside the book) to its QR content
     image_qr_map = {}
     report_entries = []
     
@@ -20,74 +227,113 @@ def run(content_dir, project_root):
     image_extensions = ('.png', '.jpg', '.jpeg', '.webp')
 
     # Pass 1: Scan all images
-    for root, _, files in os.walk(content_dir):
-        for file in files:
-            if file.lower().endswith(image_extensions):
-                file_path = os.path.join(root, file)
-                try:
-                    # Normalize path for matching
-                    abs_path = os.path.abspath(file_path)
-                    
-                    with Image.open(abs_path) as img:
-                        decoded_objects = decode(img)
-                        for obj in decoded_objects:
-                            qr_data = obj.data.decode("utf-8")
-                            qr_type = obj.type
-                            
-                            if qr_type == 'QRCODE':
-                                logging.info(f"QR Code found in {file}: {qr_data}")
-                                image_qr_map[abs_path] = qr_data
-                                report_entries.append((file, qr_data))
-                except Exception as e:
-                    logging.warning(f"Could not scan image {file}: {e}")
+    prescreen = Config.QR_PRESCREEN if prescreen is None else prescreen
+    image_paths = [path for path in book.content_files('image') if path.lower().endswith(image_extensions)]
+    unreferenced = 0
+    if prescreen:
+        if numpy is None:
+            logging.warning("NumPy is not installed: the QR pre-screen only checks the image size.")
+        referenced = referenced_images(store)
+        unreferenced = sum(1 for path in image_paths if path not in referenced)
+        image_paths = [path for path in image_paths if path in referenced]
+    cache = QRCache() if use_cache else None
+    try:
+        # Large JPEGs are decoded at a reduced size, which can change what is found
+        decoder = f"{DECODER_VERSION}/{Config.QR_MAX_DECODE_SIZE}"
+        keys = {}
+        cached = {}
+
+        def uncached_images():
+            # Each image is read once: hashed for the cache lookup, then decoded from the same bytes
+            for path in image_paths:
+                data = book.read_bytes(path)
+                if cache:
+                    keys[path] = QRCache.key(data, decoder)
+                    payloads = cache.get(keys[path])
+                    if payloads is not None:
+                        cached[path] = (payloads, None)
+                        continue
+                yield path, data
+
+        decoded = decode_images(uncached_images(), min(workers, len(image_paths)), prescreen)
+
+        if cache:
+            # Failed images are not cached, so they are tried again next time, nor the ones the
+            # pre-screen rejected: pyzbar never saw them, and QR_PRESCREEN=0 must scan them
+            cache.put_many({keys[path]: payloads for path, (payloads, error) in decoded.items()
+                            if error is None and payloads is not None})
+            if image_paths:
+                logging.info(f"QR cache: {cache.hits}/{len(image_paths)} images from cache ({100 * cache.hits / len(image_paths):.0f}% hit rate).")
+    finally:
+        if cache:
+            cache.close()
+
+    rejected = sum(1 for payloads, error in decoded.values() if payloads is None and error is None)
+    if prescreen:
+        logging.info(f"QR pre-screen: {unreferenced} unreferenced images skipped, {rejected} rejected, "
+                     f"{len(decoded) - rejected} scanned, {len(cached)} from cache.")
+
+    # Results are reported in book order, whichever process decoded them
+    for image_path in image_paths:
+        file = posixpath.basename(image_path)
+        payloads, error = cached.get(image_path) or decoded[image_path]
+        if error is not None:
+            logging.warning(f"Could not scan image {file}: {error}")
+            continue
+        if payloads is None:
+            continue
+        for qr_data in payloads:
+            logging.info(f"QR Code found in {file}: {qr_data}")
+            image_qr_map[image_path] = qr_data
+            report_entries.append((file, qr_data))
 
     # Pass 2: Modify XHTML files
     if image_qr_map:
         logging.info("Modifying XHTML files to link QR codes...")
         modified_files_count = 0
+        # File names as they can appear in a src, raw or with character references
+        qr_names = set()
+        for image_path in image_qr_map:
+            name = posixpath.basename(image_path)
+            qr_names.update((name, html.escape(name, quote=False), html.escape(name)))
         
-        for root, _, files in os.walk(content_dir):
-            for file in files:
-                if file.lower().endswith('.xhtml'):
-                    xhtml_path = os.path.join(root, file)
-                    modified = False
-                    
-                    with open(xhtml_path, 'r', encoding='utf-8') as f:
-                        soup = BeautifulSoup(f.read(), 'html.parser')
+        for doc in store.gated("QR linking", lambda text: references_any(text, qr_names)):
+            if not doc.name.lower().endswith('.xhtml'):
+                continue
+            
+            xhtml_path = doc.path
+            modified = False
+            soup = doc.soup
+            
+            for img in doc.index.tags('img'):
+                src = img.get('src')
+                if not src:
+                    continue
+                
+                img_path = image_path_of(xhtml_path, src)
+                
+                if img_path in image_qr_map:
+                    qr_url = image_qr_map[img_path]
                     
-                    for img in soup.find_all('img'):
-                        src = img.get('src')
-                        if not src:
-                            continue
+                    # Check if already wrapped in <a>
+                    parent = img.parent
+                    if parent and parent.name == 'a':
+                        continue
                         
-                        # Resolve src relative to the current xhtml file
-                        img_rel_path = os.path.join(os.path.dirname(xhtml_path), src)
-                        img_abs_path = os.path.abspath(img_rel_path)
-                        
-                        if img_abs_path in image_qr_map:
-                            qr_url = image_qr_map[img_abs_path]
-                            
-                            # Check if already wrapped in <a>
-                            parent = img.parent
-                            if parent and parent.name == 'a':
-                                continue
-                                
-                            # Wrap in <a> tag
-                            new_link = soup.new_tag('a', href=qr_url, target="_blank")
-                            img.wrap(new_link)
-                            modified = True
-                            logging.debug(f"Linked QR image {src} in {file}")
-
-                    if modified:
-                        with open(xhtml_path, 'w', encoding='utf-8') as f:
-                            f.write(str(soup))
-                        modified_files_count += 1
+                    # Wrap in <a> tag
+                    new_link = soup.new_tag('a', href=qr_url, target="_blank")
+                    img.wrap(new_link)
+                    modified = True
+                    logging.debug(f"Linked QR image {src} in {doc.name}")
+
+            if modified:
+                doc.mark_modified()
+                modified_files_count += 1
 
         logging.info(f"XHTML modification completed. Files modified: {modified_files_count}")
 
     # Report Generation
     if report_entries:
-        report_path = os.path.join(project_root, "qr_code_report.txt")
         try:
             with open(report_path, "w", encoding="utf-8") as f:
                 f.write("QR Code Scan Report\n")
@@ -101,3 +347,4 @@ def run(content_dir, project_root):
             logging.error(f"Failed to write QR report: {e}")
     else:
         logging.info("No QR codes found.")
+    return len(report_entries)
@@ -1,51 +1,180 @@
-import os
 import requests
 import logging
 import json
-from bs4 import BeautifulSoup
 from config import Config
 
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from utils.ai_cache import AICache
+from utils.circuit_breaker import CircuitBreaker
 
-def analyze_table_with_ai(rows_text):
+# Bump whenever the prompts or payloads below change, so cached answers are not reused
+PROMPT_VERSION = 2
+
+# Rules shared by the single-table and batch prompts
+PROMPT_RULES = (
+    "If the row are mostly uppercase mark it as a topic header"
+    "If the row are mostly lowercase DON'T mark it!"
+    "The last row in a table is never a topic header"
+    "If there is bullet in the row it isn't a topic header"
+    "If it is an extensive paragraph in the row it isn't a topic header"
+    "Never all of the rows are simoultaneously topic headers!"
+)
+
+# First JSON array of row numbers in an answer
+ANSWER_ARRAY = re.compile(r'\[\s*\d*(?:\s*,\s*\d+)*\s*\]')
+
+# Schema of the per-table answer, for providers with structured output
+ROWS_SCHEMA = {"type": "array", "items": {"type": "integer", "minimum": 0}}
+
+# Providers known to accept a json_schema response_format with an array root
+STRUCTURED_OUTPUT_PROVIDERS = ("lm-studio",)
+
+class AIUnavailable(Exception):
     """
-    Sends the entire table content to the configured AI provider to identify topic rows.
-    Returns a dictionary with indices, time taken, and tokens used.
+    Raised instead of calling the AI once the deadline has passed or the circuit is open.
+    """
+
+
+class AIGuard:
+    """
+    Applies the AI deadline of a book (a time.time() value, or None) and the
+    circuit breaker to every request.
     """
-    if not rows_text:
-        return {"indices": [], "time": 0, "tokens": 0}
 
+    def __init__(self, deadline=None, breaker=None):
+        self.deadline = deadline
+        self.breaker = breaker
+
+    def before_call(self):
+        """
+        Returns the timeout of the next request or raises AIUnavailable.
+        """
+        timeout = 30
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise AIUnavailable("AI deadline reached")
+            # A request may overrun the deadline by up to a second
+            timeout = max(1, min(timeout, remaining))
+        if self.breaker and not self.breaker.allow():
+            raise AIUnavailable("AI circuit open")
+        return timeout
+
+    def record(self, ok):
+        if self.breaker:
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+# One breaker per process, so the books that follow in a batch or watch worker
+# don't wait on an endpoint that is already known to be down
+_breaker = None
+
+def get_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker("AI endpoint", Config.AI_BREAKER_FAILURES, Config.AI_BREAKER_COOLDOWN)
+    return _breaker
+
+def create_session(concurrency):
+    """
+    Keep-alive session whose connection pool fits the number of concurrent calls.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, concurrency))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def format_table(rows_text):
     # Build a numbered list string for the prompt
-    table_str = "\n".join([f"Row {i}: {text[:100]}" for i, text in enumerate(rows_text)])
-    
-    prompt = (
-        "You are an expert document structure analyzer.\n"
-        "Your task: Identify rows in the table below that serve as 'Topic Headers', 'Titles', or 'Section Separators'.\n"
-        "These are distinct from regular data rows.\n\n"
-        "Input Table:\n"
-        f"{table_str}\n\n"
-        "CRITICAL: Return ONLY a JSON array of integers containing the row numbers (indices) of the topic headers.\n"
-        "Example output: [0, 5]\n"
-        "If no topics are found, return: []\n"
-        "Do not write explanations, introductions, or any other text. Only the JSON array."
-        "If the row are mostly uppercase mark it as a topic header"
-        "If the row are mostly lowercase DON'T mark it!"
-        "The last row in a table is never a topic header"
-        "If there is bullet in the row it isn't a topic header"
-        "If it is an extensive paragraph in the row it isn't a topic header"
-        "Never all of the rows are simoultaneously topic headers!"
-    )
-    
+    return "\n".join([f"Row {i}: {text[:100]}" for i, text in enumerate(rows_text)])
+
+def estimate_tokens(text):
+    # Rough count (about 4 characters per token), only used to size the batches
+    return len(text) // 4 + 1
+
+def answer_max_tokens(rows_count, tables=1):
+    """
+    max_tokens of a request, sized to the answer: room for every row number (and
+    table id), plus Config.AI_REASONING_TOKENS (0 by default) for models that reason first.
+    """
+    return Config.AI_REASONING_TOKENS + 4 * rows_count + 10 * tables + 10
+
+def structured_output():
+    """
+    Whether requests ask for a JSON schema constrained answer (Config.AI_STRUCTURED_OUTPUT,
+    off by default: "auto" turns it on for the providers known to support it).
+    """
+    if Config.AI_STRUCTURED_OUTPUT == "auto":
+        return Config.AI_PROVIDER in STRUCTURED_OUTPUT_PROVIDERS
+    return Config.AI_STRUCTURED_OUTPUT in ("1", "true", "yes")
+
+def read_stream(response, stop=None, until=None):
+    """
+    Reads a server-sent events completion until [DONE], or until stop(content)
+    reports the answer is complete, and closes the stream either way so the
+    model stops generating. Gives up with a Timeout after until (a time.time() value).
+    Returns (content, reasoning, tokens reported by the server or 0, stopped early).
+    """
+    content = ""
+    reasoning = ""
+    tokens = 0
+    try:
+        for line in response.iter_lines():
+            if until is not None and time.time() > until:
+                raise requests.exceptions.Timeout("AI stream passed the deadline")
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            tokens = (chunk.get("usage") or {}).get("total_tokens", tokens)
+            if not chunk.get("choices"):
+                continue
+            delta = chunk["choices"][0].get("delta", {})
+            reasoning += delta.get("reasoning") or delta.get("reasoning_content") or ""
+            if delta.get("content"):
+                content += delta["content"]
+                if stop and stop(content):
+                    return content, reasoning, tokens, True
+    finally:
+        response.close()
+    return content, reasoning, tokens, False
+
+def post_prompt(system_prompt, prompt, session=None, max_tokens=1000, guard=None, stream=False, stop=None, schema=None):
+    """
+    Sends one chat completion request to the configured AI provider.
+    With stream, the answer is read as it is generated and the request ends as
+    soon as stop(content) is true. With schema, providers with structured output
+    are asked for an answer matching it.
+    Returns (content, reasoning, tokens, stopped early). Raises on network and HTTP
+    errors, and AIUnavailable when the guard doesn't allow the call.
+    """
+    timeout = guard.before_call() if guard else 30
+
     payload = {
         "model": Config.AI_MODEL,
         "messages": [
-            {"role": "system", "content": "You are a specialized document analyzer that ONLY outputs JSON arrays. Do not reason aloud. Do not explain. Just output the array."},
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt}
         ],
         "temperature": 0,
-        "max_tokens": 1000  # Increased for models that reason extensively
+        "max_tokens": max_tokens
     }
+    if schema and structured_output():
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "topic_rows", "strict": True, "schema": schema}
+        }
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
     
     headers = {
         "Content-Type": "application/json"
@@ -58,123 +187,463 @@ def analyze_table_with_ai(rows_text):
         headers["HTTP-Referer"] = "https://github.com/jorgelzsilva/epub_automation"
         headers["X-Title"] = "EPUB Automation"
 
-    print(f"  [AI] Analyzing Table ({len(rows_text)} rows) using {Config.AI_PROVIDER}... ", end="", flush=True)
+    stopped = False
+    try:
+        response = (session or requests).post(Config.AI_API_URL, json=payload, headers=headers, timeout=timeout, stream=stream)
+        response.raise_for_status()
+        if stream:
+            content, reasoning, tokens, stopped = read_stream(response, stop, guard.deadline if guard else None)
+            content = content.strip()
+            if not tokens:
+                # No usage block when the stream is cut (or the server doesn't send one)
+                tokens = estimate_tokens(system_prompt + prompt) + estimate_tokens(content + reasoning)
+        else:
+            data = response.json()
+            content = data['choices'][0]['message'].get('content', '').strip()
+            # Fallback for models that might put the answer in 'reasoning'
+            reasoning = data['choices'][0]['message'].get('reasoning', '')
+            tokens = data.get("usage", {}).get("total_tokens", 0)
+    except Exception:
+        if guard:
+            guard.record(False)
+        raise
+    if guard:
+        guard.record(True)
+    return content, reasoning, tokens, stopped
+
+def analyze_table_with_ai(rows_text, session=None, guard=None, stream=False):
+    """
+    Sends the entire table content to the configured AI provider to identify topic rows.
+    With stream, the request ends at the first complete JSON array of the answer.
+    Returns a dictionary with indices, time taken, tokens used, whether the response
+    could be parsed (ok) and otherwise the error. skipped is set when the guard
+    refused the call.
+    """
+    if not rows_text:
+        return {"indices": [], "time": 0, "tokens": 0, "ok": True, "error": None, "skipped": False}
+
+    table_str = format_table(rows_text)
+    
+    prompt = (
+        "You are an expert document structure analyzer.\n"
+        "Your task: Identify rows in the table below that serve as 'Topic Headers', 'Titles', or 'Section Separators'.\n"
+        "These are distinct from regular data rows.\n\n"
+        "Input Table:\n"
+        f"{table_str}\n\n"
+        "CRITICAL: Return ONLY a JSON array of integers containing the row numbers (indices) of the topic headers.\n"
+        "Example output: [0, 5]\n"
+        "If no topics are found, return: []\n"
+        "Do not write explanations, introductions, or any other text. Only the JSON array."
+        f"{PROMPT_RULES}"
+    )
+    system_prompt = "You are a specialized document analyzer that ONLY outputs JSON arrays. Do not reason aloud. Do not explain. Just output the array."
+
+    # Printed as a single line once the call is over, so concurrent calls don't interleave
+    message = f"  [AI] Analyzing Table ({len(rows_text)} rows) using {Config.AI_PROVIDER}... "
     
     start_time = time.time()
-    result = {"indices": [], "time": 0, "tokens": 0}
+    result = {"indices": [], "time": 0, "tokens": 0, "ok": False, "error": None, "skipped": False}
     
     try:
-        response = requests.post(Config.AI_API_URL, json=payload, headers=headers, timeout=30)
+        content, reasoning, result["tokens"], stopped = post_prompt(
+            system_prompt, prompt, session, answer_max_tokens(len(rows_text)), guard,
+            stream, ANSWER_ARRAY.search, ROWS_SCHEMA
+        )
         result["time"] = time.time() - start_time
+        full_text = content + "\n" + reasoning
+        if stopped:
+            message += "(stream closed at the answer) "
         
-        if response.status_code == 200:
-            data = response.json()
-            result["tokens"] = data.get("usage", {}).get("total_tokens", 0)
-            
-            content = data['choices'][0]['message'].get('content', '').strip()
-            # Fallback for models that might put the answer in 'reasoning'
-            reasoning = data['choices'][0]['message'].get('reasoning', '')
-            full_text = content + "\n" + reasoning
-            
-            # Use regex to find the first bracketed list in the response
-            match = re.search(r'\[\s*\d*(?:\s*,\s*\d+)*\s*\]', full_text)
-            
-            if match:
-                json_str = match.group(0)
-                try:
-                    result["indices"] = json.loads(json_str)
-                    print(f"-> Detected Topics: {result['indices']}")
-                except json.JSONDecodeError:
-                    print(f"-> JSON Error in extracted string: {json_str}")
-            else:
-                 print(f"-> Parsing Error. Raw Response: '{content[:100]}...' [Reasoning len: {len(reasoning)}]")
+        # Use regex to find the first bracketed list in the response
+        match = ANSWER_ARRAY.search(full_text)
+        
+        if match:
+            json_str = match.group(0)
+            try:
+                result["indices"] = json.loads(json_str)
+                result["ok"] = True
+                message += f"-> Detected Topics: {result['indices']}"
+            except json.JSONDecodeError:
+                message += f"-> JSON Error in extracted string: {json_str}"
+                result["error"] = "unparsed answer"
+        else:
+             message += f"-> Parsing Error. Raw Response: '{content[:100]}...' [Reasoning len: {len(reasoning)}]"
+             result["error"] = "unparsed answer"
                  
+    except AIUnavailable as e:
+        result["error"] = str(e)
+        result["skipped"] = True
+        return result
     except Exception as e:
-        print(f"-> ERROR ({e})")
+        result["error"] = type(e).__name__
+        result["time"] = time.time() - start_time
+        message += f"-> ERROR ({e})"
         logging.warning(f"AI table check failed: {e}")
         
+    print(message, flush=True)
     return result
 
-def run(content_dir):
-    logging.info(f"Identifying table topics in {content_dir}...")
-    metrics = {
-        "total_ai_time": 0,
-        "total_tokens": 0,
-        "ai_calls": 0
-    }
-    
-    for root, _, files in os.walk(content_dir):
-        for file in files:
-            if not (file.endswith('.xhtml') or file.endswith('.html')):
-                continue
-                
-            file_path = os.path.join(root, file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-            soup = BeautifulSoup(content, 'html.parser')
-            modified = False
+def parse_batch_answer(text, table_ids):
+    """
+    Finds the first JSON object in text that maps every table id to a list of integers.
+    Returns {table id: indices} or None.
+    """
+    for match in re.finditer(r'\{[^{}]*\}', text):
+        try:
+            answer = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(answer, dict) or not all(isinstance(answer.get(t), list) for t in table_ids):
+            continue
+        return {t: [i for i in answer[t] if isinstance(i, int)] for t in table_ids}
+    return None
+
+def analyze_batch_with_ai(tables, session=None, guard=None, stream=False):
+    """
+    Sends several tables in one prompt, each under an id (T0, T1, ...), and maps
+    the per-table answer back. A single table uses the regular prompt.
+    If the answer can't be parsed, the tables are retried one request each.
+    Returns {"indices": [...], "ok": [...], "errors": [...]} (one entry per table)
+    with the total time, tokens and number of calls.
+    """
+    if len(tables) == 1:
+        result = analyze_table_with_ai(tables[0], session, guard, stream)
+        return {"indices": [result["indices"]], "ok": [result["ok"]], "errors": [result["error"]],
+                "time": result["time"], "tokens": result["tokens"], "calls": 0 if result["skipped"] else 1}
+
+    table_ids = [f"T{n}" for n in range(len(tables))]
+    tables_str = "\n\n".join(f"Table {t}:\n{format_table(rows_text)}" for t, rows_text in zip(table_ids, tables))
+    prompt = (
+        "You are an expert document structure analyzer.\n"
+        "Your task: For each table below, identify rows that serve as 'Topic Headers', 'Titles', or 'Section Separators'.\n"
+        "These are distinct from regular data rows. Row numbers restart at 0 in each table.\n\n"
+        "Input Tables:\n"
+        f"{tables_str}\n\n"
+        "CRITICAL: Return ONLY a JSON object mapping every table id to a JSON array of integers containing the row numbers (indices) of its topic headers.\n"
+        f'Example output: {{"T0": [0, 5], "T1": []}}\n'
+        "Use [] for the tables without topics.\n"
+        "Do not write explanations, introductions, or any other text. Only the JSON object."
+        f"{PROMPT_RULES}"
+    )
+    system_prompt = "You are a specialized document analyzer that ONLY outputs JSON objects. Do not reason aloud. Do not explain. Just output the object."
+
+    rows_count = sum(len(rows_text) for rows_text in tables)
+    message = f"  [AI] Analyzing {len(tables)} Tables ({rows_count} rows) in one request using {Config.AI_PROVIDER}... "
+    start_time = time.time()
+    batch = {"indices": [[] for _ in tables], "ok": [False] * len(tables), "errors": [None] * len(tables),
+             "time": 0, "tokens": 0, "calls": 1}
+
+    answer = None
+    try:
+        schema = {"type": "object", "properties": {t: ROWS_SCHEMA for t in table_ids},
+                  "required": table_ids, "additionalProperties": False}
+        content, reasoning, batch["tokens"], stopped = post_prompt(
+            system_prompt, prompt, session, answer_max_tokens(rows_count, len(tables)), guard,
+            stream, lambda text: parse_batch_answer(text, table_ids) is not None, schema
+        )
+        answer = parse_batch_answer(content + "\n" + reasoning, table_ids)
+        if stopped:
+            message += "(stream closed at the answer) "
+        message += f"-> Detected Topics: {answer}" if answer is not None else f"-> Parsing Error. Raw Response: '{content[:100]}...'"
+    except AIUnavailable as e:
+        batch["calls"] = 0
+        batch["errors"] = [str(e)] * len(tables)
+        return batch
+    except Exception as e:
+        message += f"-> ERROR ({e})"
+        logging.warning(f"AI batch check failed: {e}")
+        # The endpoint failed, not the answer: retrying table by table won't help
+        batch["errors"] = [type(e).__name__] * len(tables)
+    batch["time"] = time.time() - start_time
+    print(message, flush=True)
+
+    if answer is not None:
+        batch["indices"] = [answer[t] for t in table_ids]
+        batch["ok"] = [True] * len(tables)
+        return batch
+    if batch["errors"][0] is not None:
+        return batch
+
+    # Unparsed answer: fall back to one request per table
+    for n, rows_text in enumerate(tables):
+        result = analyze_table_with_ai(rows_text, session, guard, stream)
+        batch["indices"][n] = result["indices"]
+        batch["ok"][n] = result["ok"]
+        batch["errors"][n] = result["error"]
+        batch["time"] += result["time"]
+        batch["tokens"] += result["tokens"]
+        batch["calls"] += 0 if result["skipped"] else 1
+    return batch
+
+# Rows starting with one of these are list items, never topic headers
+BULLETS = ('•', '●', '○', '▪', '■', '◦', '►', '➢', '✓', '-', '–', '—', '*')
+# Rows longer than this are paragraphs, never topic headers
+MAX_TOPIC_WORDS = 20
+
+def classify_row(text, is_last):
+    """
+    Applies the rules of the AI prompt to one row.
+    Returns True (topic header), False (regular row) or None when the rules can't tell.
+    """
+    if is_last:
+        return False
+    stripped = text.strip()
+    if not stripped or stripped.startswith(BULLETS):
+        return False
+    words = stripped.split()
+    if len(words) > MAX_TOPIC_WORDS:
+        return False
+
+    letters = [c for c in stripped if c.isalpha()]
+    if len(letters) < 3:
+        # Numbers, symbols or a single letter: leave it to the AI
+        return None
+    upper_ratio = sum(1 for c in letters if c.isupper()) / len(letters)
+    if upper_ratio >= 0.9:
+        return True
+    if upper_ratio <= 0.3:
+        # Short Title Case rows ("Fatores de Risco") may still be headers;
+        # connectives like "de", "da", "com" are ignored
+        significant = [w for w in words if len(w) > 3 and w[0].isalpha()]
+        if len(words) <= 6 and significant and all(w[0].isupper() for w in significant):
+            return None
+        return False
+    return None
+
+def classify_table(rows_text):
+    """
+    Decides a table locally when every row is clear-cut.
+    Returns the topic indices, or None when the table has to go to the AI.
+    """
+    indices = []
+    for i, text in enumerate(rows_text):
+        decision = classify_row(text, i == len(rows_text) - 1)
+        if decision is None:
+            return None
+        if decision:
+            indices.append(i)
+    # The last row is never a header, so a decided table never has all rows as headers
+    return indices
+
+def fallback_indices(rows_text):
+    """
+    Topic indices used when the AI can't answer: only the rows the rules are sure about.
+    """
+    return [i for i, text in enumerate(rows_text) if classify_row(text, i == len(rows_text) - 1)]
+
+def may_have_target_rows(text):
+    """
+    Pre-scan gate: only rows with the Quadro-ou-Tabela class are classified.
+    """
+    return 'Quadro-ou-Tabela' in text
+
+def collect_tables(store):
+    """
+    Collects the tables of the book that have rows to classify.
+    Returns a list of (doc, rows, target_rows, target_indices).
+    """
+    jobs = []
+    for doc in store.gated("Topic identification", may_have_target_rows):
+        soup = doc.soup
+        
+        # Find all tables with class 'Quadro-ou-Tabela' (or contain TRs with it?)
+        # User previously said: <tr class="Quadro-ou-Tabela">
+        # A table might contain multiple such TRs. 
+        # We should group them by table to maintain context.
+        
+        tables = doc.index.tags('table')
+        
+        for table in tables:
+            # Optimization: Skip tables that clearly don't have the target class in any way
+            # (We will check rows inside)
             
-            # Find all tables with class 'Quadro-ou-Tabela' (or contain TRs with it?)
-            # User previously said: <tr class="Quadro-ou-Tabela">
-            # A table might contain multiple such TRs. 
-            # We should group them by table to maintain context.
+            # Get rows ONLY from tbody if possible to avoid thead titles
+            tbody = table.find('tbody')
+            if tbody:
+                rows = tbody.find_all('tr')
+            else:
+                # Fallback if no tbody, but try to exclude thead
+                thead = table.find('thead')
+                all_rows = table.find_all('tr')
+                if thead:
+                    # Tags compare by content, so match the thead rows by identity
+                    thead_rows = {id(r) for r in thead.find_all('tr')}
+                    rows = [r for r in all_rows if id(r) not in thead_rows]
+                else:
+                    rows = all_rows
             
-            tables = soup.find_all('table')
+            target_rows = []
+            target_indices = []
             
-            for table in tables:
-                # Optimization: Skip tables that clearly don't have the target class in any way
-                # (We will check rows inside)
-                
-                # Get rows ONLY from tbody if possible to avoid thead titles
-                tbody = table.find('tbody')
-                if tbody:
-                    rows = tbody.find_all('tr')
-                else:
-                    # Fallback if no tbody, but try to exclude thead
-                    thead = table.find('thead')
-                    all_rows = table.find_all('tr')
-                    if thead:
-                        thead_rows = thead.find_all('tr')
-                        rows = [r for r in all_rows if r not in thead_rows]
-                    else:
-                        rows = all_rows
-                
-                target_rows = []
-                target_indices = []
-                
-                for i, row in enumerate(rows):
-                    # Only analyze rows with the specific class "Quadro-ou-Tabela"
-                    if 'Quadro-ou-Tabela' not in row.get('class', []):
-                        continue
-                        
-                    text = row.get_text(separator=" ", strip=True)
-                    target_rows.append(text)
-                    target_indices.append(i)
-                    
-                if not target_rows:
+            for i, row in enumerate(rows):
+                # Only analyze rows with the specific class "Quadro-ou-Tabela"
+                if 'Quadro-ou-Tabela' not in row.get('class', []):
                     continue
+                    
+                text = row.get_text(separator=" ", strip=True)
+                target_rows.append(text)
+                target_indices.append(i)
+                
+            if target_rows:
+                jobs.append((doc, rows, target_rows, target_indices))
+    return jobs
+
+def plan_batches(jobs, batch_tokens):
+    """
+    Groups tables (positions in jobs) into prompts of at most batch_tokens estimated
+    tokens, in book order. Without a budget, or for tables bigger than the budget,
+    each table gets its own request.
+    """
+    if not batch_tokens:
+        return [[n] for n in range(len(jobs))]
+
+    batches = []
+    current = []
+    current_tokens = 0
+    for n, (_, _, target_rows, _) in enumerate(jobs):
+        tokens = estimate_tokens(format_table(target_rows))
+        if current and current_tokens + tokens > batch_tokens:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(n)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def analyze_tables(jobs, concurrency, batch_tokens=0, guard=None, stream=False):
+    """
+    Runs the AI analysis of every table, at most concurrency requests at a time
+    over a shared keep-alive session, packing small tables together when
+    batch_tokens is set. Returns a list of (positions in jobs, batch result).
+    """
+    batches = plan_batches(jobs, batch_tokens)
 
-                ai_result = analyze_table_with_ai(target_rows)
-                topic_indices = ai_result["indices"]
-                metrics["total_ai_time"] += ai_result["time"]
-                metrics["total_tokens"] += ai_result["tokens"]
-                metrics["ai_calls"] += 1
+    def analyze(batch):
+        return batch, analyze_batch_with_ai([jobs[n][2] for n in batch], session, guard, stream)
+
+    with create_session(concurrency) as session:
+        if concurrency <= 1 or len(batches) <= 1:
+            return [analyze(batch) for batch in batches]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(analyze, batches))
+
+def run(store, concurrency=None, use_cache=True, refresh=False, use_rules=True, batch_tokens=None, deadline=None, stream=None):
+    """
+    Marks topic rows of the tables with the 'topico' class.
+    All the tables of the book are collected first. With use_rules, clear-cut
+    tables are decided locally by classify_table and never reach the AI.
+    The rest are sent to the AI concurrently (Config.AI_CONCURRENCY calls at
+    a time unless concurrency is given); the classes are applied once every
+    response is in. With a batch_tokens budget (Config.AI_BATCH_TOKENS by default)
+    small tables share a request.
+    With use_cache, answers are read from and saved to the AI cache; refresh skips
+    the lookups (e.g. after a prompt change) but still saves the new answers.
+    No request is sent after deadline (a time.time() value) or while the circuit
+    breaker is open. Tables without an AI answer are listed in skipped_tables;
+    with use_rules they fall back to fallback_indices, otherwise they stay unmarked.
+    With stream (Config.AI_STREAM by default), answers are streamed and each
+    request ends as soon as its JSON answer is complete.
+    total_ai_time is the sum of the call times, wall_time the time the stage waited.
+    """
+    logging.info(f"Identifying table topics in {store.content_dir}...")
+    metrics = {
+        "total_ai_time": 0,
+        "total_tokens": 0,
+        "ai_calls": 0,
+        "wall_time": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "tables": 0,
+        "rule_decisions": 0,
+        "skipped_tables": []
+    }
+    concurrency = concurrency or Config.AI_CONCURRENCY
+    batch_tokens = Config.AI_BATCH_TOKENS if batch_tokens is None else batch_tokens
+    stream = Config.AI_STREAM if stream is None else stream
+
+    start_time = time.time()
+    jobs = collect_tables(store)
+    results = [None] * len(jobs)
+    metrics["tables"] = len(jobs)
+
+    if use_rules:
+        for i, (_, _, target_rows, _) in enumerate(jobs):
+            indices = classify_table(target_rows)
+            if indices is not None:
+                results[i] = {"indices": indices, "time": 0, "tokens": 0, "ok": True}
+                metrics["rule_decisions"] += 1
+
+    undecided = [i for i, result in enumerate(results) if result is None]
+    cache = AICache() if use_cache and undecided else None
+    try:
+        keys = {i: AICache.key(jobs[i][2], PROMPT_VERSION) for i in undecided} if cache else {}
+        if cache and not refresh:
+            for i in undecided:
+                results[i] = cache.get(keys[i])
+
+        pending = [i for i in undecided if results[i] is None]
+        if pending:
+            logging.info(f"Sending {len(pending)} tables to the AI, {concurrency} requests at a time.")
+        guard = AIGuard(deadline, get_breaker())
+        for batch, batch_result in analyze_tables([jobs[i] for i in pending], concurrency, batch_tokens, guard, stream):
+            metrics["total_ai_time"] += batch_result["time"]
+            metrics["total_tokens"] += batch_result["tokens"]
+            metrics["ai_calls"] += batch_result["calls"]
+            for n, indices, ok, error in zip(batch, batch_result["indices"], batch_result["ok"], batch_result["errors"]):
+                i = pending[n]
+                results[i] = {"indices": indices, "ok": ok, "error": error}
+                # Failed calls are not cached so the table is retried next run
+                if cache and ok:
+                    cache.put(keys[i], indices, batch_result["tokens"] // len(batch))
+
+        if cache:
+            metrics["cache_hits"] = cache.hits
+            metrics["cache_misses"] = len(pending)
+    finally:
+        if cache:
+            cache.close()
+    metrics["wall_time"] = time.time() - start_time
+
+    for i, result in enumerate(results):
+        if result.get("ok", True):
+            continue
+        doc, rows, target_rows, target_indices = jobs[i]
+        result["indices"] = fallback_indices(target_rows) if use_rules else []
+        table = rows[target_indices[0]].find_parent('table')
+        tables = doc.index.tags('table')
+        metrics["skipped_tables"].append({
+            "file": doc.path,
+            "table": next((n for n, t in enumerate(tables, 1) if t is table), None),
+            "table_id": table.get('id') if table else None,
+            "first_row": target_rows[0][:60],
+            "reason": result["error"]
+        })
+    if metrics["skipped_tables"]:
+        fallback = "were marked by the local rules only" if use_rules else "were left unmarked"
+        logging.warning(f"{len(metrics['skipped_tables'])} tables got no AI answer and {fallback}.")
+
+    logging.info(f"Tables: {metrics['tables']} (rules: {metrics['rule_decisions']}, "
+                 f"AI cache: {metrics['cache_hits']}, AI calls: {metrics['ai_calls']})")
+
+    modified_docs = {}
+    for (doc, rows, target_rows, target_indices), ai_result in zip(jobs, results):
+        topic_indices = ai_result["indices"]
+        
+        for idx in topic_indices:
+            if isinstance(idx, int) and 0 <= idx < len(target_rows):
+                # Map back to the original row object
+                original_row_index = target_indices[idx]
+                row = rows[original_row_index]
                 
-                for idx in topic_indices:
-                    if isinstance(idx, int) and 0 <= idx < len(target_rows):
-                        # Map back to the original row object
-                        original_row_index = target_indices[idx]
-                        row = rows[original_row_index]
-                        
-                        classes = row.get('class', [])
-                        if 'topico' not in classes:
-                            row['class'] = classes + ['topico']
-                            modified = True
-                            logging.info(f"Marked topic in {file} (Table Row {original_row_index}): {target_rows[idx][:30]}...")
-
-            if modified:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(str(soup))
+                classes = row.get('class', [])
+                if 'topico' not in classes:
+                    row['class'] = classes + ['topico']
+                    modified_docs[doc.path] = doc
+                    logging.info(f"Marked topic in {doc.name} (Table Row {original_row_index}): {target_rows[idx][:30]}...")
+
+    for doc in modified_docs.values():
+        doc.mark_modified()
     
     return metrics
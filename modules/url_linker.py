@@ -1,40 +1,70 @@
-import os
 import re
 import logging
 from bs4 import BeautifulSoup
+from utils.markup import parse
 
-def run(content_dir):
+# Regex to match URLs (simple version)
+URL_PATTERN = re.compile(r'(https?://[^\s<>"{}|\\^`\[\]]+)')
+
+def may_have_urls(text):
+    """
+    Pre-scan gate: only the body is linked, and the head always holds a URL (the xmlns).
+    """
+    body = text.find('<body')
+    return body != -1 and URL_PATTERN.search(text, body) is not None
+
+def link_urls(soup):
+    """
+    Wraps the URLs found in the body text nodes of a parsed document.
+    Returns None if the document has no body, otherwise whether it was modified.
+    """
+    body = soup.body
+    if not body:
+        return None
+    
+    modified = False
+    # Process text nodes in body
+    for text_node in body.find_all(text=True):
+        if text_node.parent.name not in ['a', 'script', 'style']:  # Avoid processing inside links or scripts
+            new_text = URL_PATTERN.sub(r'<a href="\1" target="_blank">\1</a>', text_node.string)
+            if new_text != text_node.string:
+                text_node.replace_with(BeautifulSoup(new_text, 'html.parser'))
+                modified = True
+    return modified
+
+def link_file(content):
+    """
+    Per-file task for the parallel executor.
+    Returns (new_text or None if unchanged, link_urls result).
+    """
+    soup = parse(content)
+    result = link_urls(soup)
+    if result:
+        return str(soup), result
+    return None, result
+
+def run(store, executor=None):
     """
     Finds URLs in the text content within <body> tags of XHTML files
     and wraps them in <a href="url" target="_blank">url</a>
     """
     logging.info("Processing URLs in body content...")
     
-    # Regex to match URLs (simple version)
-    url_pattern = re.compile(r'(https?://[^\s<>"{}|\\^`\[\]]+)')
-    
     count = 0
-    for root, _, filenames in os.walk(content_dir):
-        for name in filenames:
-            if name.lower().endswith('.xhtml'):
-                file_path = os.path.join(root, name)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                soup = BeautifulSoup(content, 'html.parser')
-                body = soup.body
-                if body:
-                    # Process text nodes in body
-                    for text_node in body.find_all(text=True):
-                        if text_node.parent.name not in ['a', 'script', 'style']:  # Avoid processing inside links or scripts
-                            new_text = url_pattern.sub(r'<a href="\1" target="_blank">\1</a>', text_node.string)
-                            if new_text != text_node.string:
-                                text_node.replace_with(BeautifulSoup(new_text, 'html.parser'))
-                    
-                    # Write back
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(str(soup))
-                    count += 1
-                    logging.info(f"Processed: {file_path}")
+    if executor:
+        docs = [doc for doc in store.gated("URL linking", may_have_urls, timed=False) if doc.name.lower().endswith('.xhtml')]
+        results = executor.map_documents(link_file, docs)
+        count = sum(1 for result in results if result is not None)
+    else:
+        for doc in store.gated("URL linking", may_have_urls):
+            if not doc.name.lower().endswith('.xhtml'):
+                continue
+            result = link_urls(doc.soup)
+            if result is None:
+                continue
+            if result:
+                doc.mark_modified()
+            count += 1
+            logging.info(f"Processed: {doc.path}")
     
-    logging.info(f"URL linking completed. Files processed: {count}")
\ No newline at end of file
+    logging.info(f"URL linking completed. Files processed: {count}")
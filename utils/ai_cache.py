@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from config import Config
+
+
+class AICache:
+    """
+    Persistent SQLite cache of AI table analyses.
+    The key hashes the row texts with the model, provider and prompt version, so a
+    table seen in another edition of a book is answered without calling the AI.
+    Entries older than max_age_days are dropped, and past max_entries the least
+    recently used ones go first.
+    Not thread-safe: use it from the thread that created it.
+    """
+
+    def __init__(self, path=None, max_age_days=None, max_entries=None):
+        self.path = path or os.path.join(Config.CACHE_DIR, 'ai_responses.sqlite')
+        self.max_age_days = Config.AI_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+        self.max_entries = Config.AI_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Batch workers share the database, so wait on locks instead of failing
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, indices TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+        self.evict()
+
+    @staticmethod
+    def key(rows_text, prompt_version):
+        payload = {
+            "rows": rows_text,
+            "model": Config.AI_MODEL,
+            "provider": Config.AI_PROVIDER,
+            "prompt_version": prompt_version
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Returns {"indices", "tokens", "created"} of a cached analysis, or None.
+        """
+        row = self._conn.execute("SELECT indices, tokens, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._conn:
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {"indices": json.loads(row[0]), "tokens": row[1], "created": row[2]}
+
+    def put(self, key, indices, tokens):
+        now = time.time()
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, indices, tokens, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(indices), tokens, now, now)
+            )
+
+    def evict(self):
+        """
+        Drops expired entries, then the least recently used ones above max_entries.
+        """
+        with self._conn:
+            removed = 0
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += self._conn.execute("DELETE FROM responses WHERE created < ?", (cutoff,)).rowcount
+            if self.max_entries:
+                removed += self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                ).rowcount
+        if removed:
+            logging.info(f"AI cache: evicted {removed} entries.")
+
+    def clear(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM responses")
+        logging.info(f"AI cache cleared: {self.path}")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,160 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from functools import lru_cache
+from config import Config
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Sources whose content defines the output of the pipeline
+VERSIONED_DIRS = ['modules', 'utils', os.path.join('assets', 'fonts')]
+VERSIONED_FILES = ['main.py', 'config.py', os.path.join('assets', 'jquery.min.js')]
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+@lru_cache(maxsize=None)
+def module_versions():
+    """
+    Returns {relative path: content hash} for every pipeline module and asset.
+    Any edit to a module changes its version, so stale outputs are never reused.
+    """
+    paths = [os.path.join(PROJECT_ROOT, f) for f in VERSIONED_FILES]
+    for folder in VERSIONED_DIRS:
+        folder_path = os.path.join(PROJECT_ROOT, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            if name.endswith('.pyc') or name == '__pycache__':
+                continue
+            paths.append(os.path.join(folder_path, name))
+
+    versions = {}
+    for path in paths:
+        if os.path.isfile(path):
+            versions[os.path.relpath(path, PROJECT_ROOT).replace(os.sep, '/')] = file_hash(path)
+    return versions
+
+def config_fingerprint():
+    """
+    Returns the Config values that change the output of the pipeline.
+    Defaults are covered by the hash of config.py (see VERSIONED_FILES); this
+    adds the values that can come from the environment.
+    """
+    return {
+        "regex_remove_patterns": Config.REGEX_REMOVE_PATTERNS,
+        "regex_h1_ul_fix": Config.REGEX_H1_UL_FIX,
+        "ai_model": Config.AI_MODEL,
+        "ai_provider": Config.AI_PROVIDER,
+        "html_parser": Config.HTML_PARSER,
+        "ai_structured_output": Config.AI_STRUCTURED_OUTPUT,
+        "ai_reasoning_tokens": Config.AI_REASONING_TOKENS,
+        "qr_prescreen": Config.QR_PRESCREEN,
+        "qr_max_decode_size": Config.QR_MAX_DECODE_SIZE
+    }
+
+
+class BookCache:
+    """
+    Persistent cache of processed ePubs.
+    The key combines the input content hash, the Config fingerprint, the module
+    versions and the processing options that change the output.
+    The QR report of the book is kept next to it and restored on a hit.
+    Past max_size bytes the least recently used books go first.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir or os.path.join(Config.CACHE_DIR, 'books')
+        self.max_size = Config.BOOK_CACHE_MAX_SIZE_MB * 1024 * 1024 if max_size is None else max_size
+
+    def key(self, input_path, options=None):
+        payload = {
+            "input": file_hash(input_path),
+            "config": config_fingerprint(),
+            "versions": module_versions(),
+            "options": options or {}
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.epub")
+
+    def _report_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.qr.txt")
+
+    def get(self, key, output_path, report_path=None):
+        """
+        Copies the cached output to output_path, and its QR report (if the book
+        had one) to report_path. Returns True on a cache hit.
+        """
+        cached_path = self._path(key)
+        if not os.path.exists(cached_path):
+            return False
+        shutil.copyfile(cached_path, output_path)
+        cached_report = self._report_path(key)
+        if report_path and os.path.exists(cached_report):
+            shutil.copyfile(cached_report, report_path)
+        # The modification time is the last use, for evict()
+        os.utime(cached_path)
+        return True
+
+    def put(self, key, output_path, report_path=None):
+        """
+        Stores the output of a book, with the QR report written for it if any.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Copy then rename so parallel workers never see a partial file; the
+        # report goes first, so a book found in the cache always has its report
+        if report_path:
+            self._copy_in(report_path, self._report_path(key))
+        self._copy_in(output_path, self._path(key))
+        self.evict()
+
+    @staticmethod
+    def _copy_in(path, cached_path):
+        tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, cached_path)
+
+    def evict(self):
+        """
+        Deletes the least recently used books above max_size bytes.
+        """
+        if not self.max_size or not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.epub'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                # Evicted by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            for path in (os.path.join(self.cache_dir, name), self._report_path(name[:-len('.epub')])):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"Book cache: evicted {removed} books.")
+
+    def clear(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+            logging.info(f"Book cache cleared: {self.cache_dir}")
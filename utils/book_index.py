@@ -0,0 +1,127 @@
+import logging
+import posixpath
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+
+# Extensions of each kind of member the stages look for (lowercase)
+FILE_KINDS = {
+    'xhtml': ('.xhtml', '.html'),
+    'image': ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.svg'),
+    'font': ('.ttf', '.otf', '.woff', '.woff2'),
+    'css': ('.css',),
+    'opf': ('.opf',),
+    'ncx': ('.ncx',)
+}
+
+def file_kind(path):
+    """
+    Returns the FILE_KINDS key matching the extension of path, or None.
+    """
+    lower = path.lower()
+    for kind, extensions in FILE_KINDS.items():
+        if lower.endswith(extensions):
+            return kind
+    return None
+
+
+class IndexEntry:
+    """
+    A member of the book: its size and, when listed in the OPF, its manifest id and media type.
+    """
+
+    __slots__ = ('path', 'kind', 'size', 'manifest_id', 'media_type')
+
+    def __init__(self, path, size):
+        self.path = path
+        self.kind = file_kind(path)
+        self.size = size
+        self.manifest_id = None
+        self.media_type = None
+
+
+class BookIndex:
+    """
+    Listing of the members of a book, built once when the book is opened.
+    The book keeps it up to date on every write (new members, sizes and,
+    when the OPF is rewritten, the manifest), so stages never walk the archive
+    or the work directory themselves.
+    Entries keep archive order, with members added during processing at the end.
+    """
+
+    def __init__(self, opf_path):
+        self.opf_path = opf_path
+        self.content_dir = posixpath.dirname(opf_path)
+        self._entries = {}
+        # path -> (id, media-type) of the OPF manifest items
+        self._manifest = {}
+
+    def add(self, path, size):
+        """
+        Records a new member or the new size of an existing one.
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            entry = self._entries[path] = IndexEntry(path, size)
+            entry.manifest_id, entry.media_type = self._manifest.get(path, (None, None))
+        else:
+            entry.size = size
+
+    def load_manifest(self, opf_data):
+        """
+        Reads the manifest ids and media types from the OPF (bytes or text).
+        """
+        try:
+            root = ET.fromstring(opf_data)
+        except ET.ParseError as e:
+            logging.warning(f"Could not index the OPF manifest: {e}")
+            return
+
+        self._manifest = {}
+        for element in root.iter():
+            if element.tag.split('}')[-1] != 'item' or not element.get('href'):
+                continue
+            path = posixpath.normpath(posixpath.join(self.content_dir, unquote(element.get('href'))))
+            self._manifest[path] = (element.get('id'), element.get('media-type'))
+
+        for entry in self._entries.values():
+            entry.manifest_id, entry.media_type = self._manifest.get(entry.path, (None, None))
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path):
+        return self._entries.get(path)
+
+    def paths(self, kind=None, directory=None):
+        """
+        Lists the member paths of a kind (all members if kind is None),
+        optionally only the ones under directory.
+        """
+        prefix = directory + '/' if directory else ''
+        return [path for path, entry in self._entries.items()
+                if (kind is None or entry.kind == kind) and path.startswith(prefix)]
+
+    def size(self, path):
+        return self._entries[path].size
+
+    def total_size(self, kind=None):
+        return sum(entry.size for entry in self._entries.values() if kind is None or entry.kind == kind)
+
+    def in_manifest(self, path):
+        return path in self._manifest
+
+    def summary(self):
+        """
+        Returns {kind: count} of the indexed members.
+        """
+        counts = {}
+        for entry in self._entries.values():
+            kind = entry.kind or 'other'
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
@@ -0,0 +1,51 @@
+import time
+import logging
+import threading
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service after failure_threshold consecutive failures.
+    While open, allow() refuses every call until cooldown seconds have passed; then
+    a single probe call is let through, which closes the breaker if it succeeds or
+    opens it again if it fails. Safe to share between threads.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=3, cooldown=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                # Let one probe through; other callers keep being refused until it returns
+                self.state = self.HALF_OPEN
+                logging.info(f"{self.name}: probing after {self.cooldown:.0f}s cooldown.")
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info(f"{self.name}: service recovered, circuit closed.")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                logging.warning(f"{self.name}: {self.failures} consecutive failures, circuit open for {self.cooldown:.0f}s.")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
@@ -0,0 +1,157 @@
+import time
+import posixpath
+import logging
+from utils.markup import parse
+from utils.element_index import ElementIndex
+
+
+class Document:
+    """
+    A single XHTML document of the book.
+    Keeps the raw text until a stage asks for the tree, then keeps the parsed
+    soup alive so every following stage works on the same live tree.
+    Stages that change the tree must call mark_modified(), which also drops the
+    element index built for the current tree.
+    """
+
+    def __init__(self, path, text):
+        self.path = path
+        self.name = posixpath.basename(path)
+        self.modified = False
+        self._text = text
+        self._soup = None
+        self._index = None
+        # True when the soup holds changes not yet reflected in _text
+        self._dirty = False
+
+    @property
+    def soup(self):
+        if self._soup is None:
+            self._soup = parse(self._text)
+        return self._soup
+
+    @property
+    def index(self):
+        """
+        ElementIndex of the current tree, built on first use and shared by the stages until the tree changes.
+        """
+        if self._index is None:
+            self._index = ElementIndex(self.soup)
+        return self._index
+
+    @property
+    def text(self):
+        if self._dirty:
+            self._text = str(self._soup)
+            self._dirty = False
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        # Text based stages (e.g. regex cleaning) replace the whole document.
+        # The current tree no longer matches, so it is dropped and re-parsed on demand.
+        if value == self.text:
+            return
+        self._text = value
+        self._soup = None
+        self._index = None
+        self._dirty = False
+        self.modified = True
+
+    @property
+    def parsed(self):
+        return self._soup is not None
+
+    @property
+    def snapshot(self):
+        """
+        The last serialized text, without serializing pending tree changes.
+        Enough for the pre-scan gates: stages only add markup of their own, never
+        the content another stage's gate looks for.
+        """
+        return self._text
+
+    def mark_modified(self):
+        self.modified = True
+        self._dirty = True
+        self._index = None
+
+
+class DocumentStore:
+    """
+    Book level store of the XHTML documents.
+    Each document is read once at creation, parsed at most once per text change,
+    and written back to the book once by flush() right before packaging.
+    """
+
+    def __init__(self, book, profiler=None):
+        self.book = book
+        self.content_dir = book.content_dir
+        # When profiling, the time between two yields of the iterator is the time
+        # the current stage spent on that document
+        self.profiler = profiler
+        self._documents = []
+
+        for path in book.content_files('xhtml'):
+            self._documents.append(Document(path, book.read_text(path)))
+
+        logging.info(f"Loaded {len(self._documents)} documents ({book.mode} mode)")
+
+    def __iter__(self):
+        if self.profiler is None or not self.profiler.enabled:
+            return iter(self._documents)
+        return self._timed_iter()
+
+    def _timed_iter(self):
+        for doc in self._documents:
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            yield doc
+            self.profiler.record_file(doc.path, time.perf_counter() - start_wall, time.process_time() - start_cpu)
+
+    def untimed(self):
+        """
+        Iterates the documents without recording per-file times, for work timed
+        elsewhere (FileExecutor records the time each worker spent on a file).
+        """
+        return iter(self._documents)
+
+    def gated(self, stage, predicate, timed=True):
+        """
+        Iterates the documents whose text passes predicate, a cheap substring or
+        regex check telling whether the stage can change the document at all.
+        The other documents are skipped without being parsed; their number is logged.
+        timed=False iterates them as untimed() does.
+        """
+        skipped = 0
+        for doc in (self if timed else self.untimed()):
+            if predicate(doc.snapshot):
+                yield doc
+            else:
+                skipped += 1
+        logging.info(f"{stage}: skipped {skipped} of {len(self)} files (pre-scan).")
+
+    def __len__(self):
+        return len(self._documents)
+
+    def size(self):
+        """
+        Returns the total size in bytes of the documents as they would be written.
+        """
+        return sum(len(doc.text.encode('utf-8')) for doc in self._documents)
+
+    def flush(self):
+        """
+        Serializes each modified document once and writes it back to the book.
+        Returns the number of files written.
+        """
+        written = 0
+        for doc in self._documents:
+            if not doc.modified:
+                continue
+            self.book.write_text(doc.path, doc.text)
+            doc.modified = False
+            written += 1
+
+        logging.info(f"Wrote {written} modified documents.")
+        return written
@@ -0,0 +1,48 @@
+import heapq
+from bs4.element import Tag
+
+
+class ElementIndex:
+    """
+    Tag name -> elements and class name -> elements of a parsed document, in
+    document order, built in one walk of the tree: lookups are dictionary hits
+    instead of a find_all walk each.
+    Stale as soon as the tree changes (Document drops it on mark_modified()).
+    """
+
+    def __init__(self, soup):
+        self._tags = {}
+        self._classes = {}
+        self._position = {}
+
+        position = 0
+        for element in soup.descendants:
+            if not isinstance(element, Tag):
+                continue
+            self._position[id(element)] = position
+            position += 1
+            self._tags.setdefault(element.name, []).append(element)
+            classes = element.get('class')
+            if not classes:
+                continue
+            if isinstance(classes, str):
+                classes = classes.split()
+            for cls in set(classes):
+                self._classes.setdefault(cls, []).append(element)
+
+    def tags(self, *names):
+        """
+        Returns the elements with any of the tag names, in document order (as soup.find_all(names)).
+        """
+        if len(names) == 1:
+            return list(self._tags.get(names[0], ()))
+        found = [self._tags[name] for name in names if name in self._tags]
+        if len(found) == 1:
+            return list(found[0])
+        return list(heapq.merge(*found, key=lambda element: self._position[id(element)]))
+
+    def with_class(self, name):
+        """
+        Returns the elements having the class, in document order.
+        """
+        return list(self._classes.get(name, ()))
@@ -1,6 +1,35 @@
 import zipfile
+import struct
 import os
 import shutil
+import logging
+import posixpath
+import xml.etree.ElementTree as ET
+from config import Config
+from utils.book_index import BookIndex
+
+CONTAINER_PATH = 'META-INF/container.xml'
+
+def normalize_path(path):
+    """
+    Normalizes a path inside the book to the POSIX form used by the zip archive.
+    """
+    path = posixpath.normpath(path.replace('\\', '/'))
+    return '' if path == '.' else path
+
+def find_opf_in_container(container_xml):
+    """
+    Returns the full-path of the first rootfile declared in META-INF/container.xml.
+    """
+    try:
+        root = ET.fromstring(container_xml)
+    except ET.ParseError as e:
+        logging.warning(f"Invalid {CONTAINER_PATH}: {e}")
+        return None
+    for element in root.iter():
+        if element.tag.endswith('rootfile') and element.get('full-path'):
+            return normalize_path(element.get('full-path'))
+    return None
 
 def extract_epub(epub_path, extract_to):
     """
@@ -25,26 +54,255 @@ def extract_epub(epub_path, extract_to):
         
     return opf_path, os.path.dirname(opf_path)
 
-def package_epub(source_dir, output_path):
+# copy_raw_member writes through private ZipFile state (checked with CPython 3.8 to 3.13).
+# When an interpreter doesn't have it, members are recompressed with writestr instead.
+_ZIPFILE_INTERNALS = ('fp', 'filelist', 'NameToInfo', 'start_dir', '_didModify')
+
+def can_copy_raw(zip_in, zip_out):
     """
-    Zips a directory into an ePub file.
-    Critically, mimetype must be the first file and uncompressed.
+    Whether copy_raw_member can be used with these ZipFile objects.
     """
-    mimetype_path = os.path.join(source_dir, 'mimetype')
-    if not os.path.exists(mimetype_path):
-        # Create mimetype if missing (rare case)
-        with open(mimetype_path, 'w') as f:
-            f.write('application/epub+zip')
+    return hasattr(zip_in, 'fp') and all(hasattr(zip_out, name) for name in _ZIPFILE_INTERNALS)
 
-    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
-        # Add mimetype first (STORED / No Compression)
-        zip_out.write(mimetype_path, 'mimetype', compress_type=zipfile.ZIP_STORED)
-        
-        # Add everything else
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                if file == 'mimetype':
+def copy_raw_member(zip_in, info, zip_out, arcname, chunk_size=1024 * 1024):
+    """
+    Copies a member from zip_in to zip_out without decompressing and recompressing it.
+    The compressed bytes are copied as they are and a new local header is written with
+    the CRC and sizes of the original entry (so no data descriptor is needed).
+    Relies on ZipFile internals: check can_copy_raw() first.
+    """
+    # The local header may carry a different extra field than the central directory,
+    # so the data offset has to be read from the local header itself
+    zip_in.fp.seek(info.header_offset)
+    local_header = zip_in.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    zip_in.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    zinfo = zipfile.ZipInfo(arcname, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.flag_bits = info.flag_bits & ~0x08
+    zinfo.create_system = info.create_system
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zinfo.header_offset = zip_out.fp.tell()
+
+    zip_out.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = zip_in.fp.read(min(chunk_size, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated member {info.filename}")
+        zip_out.fp.write(chunk)
+        remaining -= len(chunk)
+
+    # What ZipFile.write does after a member, so close() writes the central directory
+    zip_out.filelist.append(zinfo)
+    zip_out.NameToInfo[zinfo.filename] = zinfo
+    zip_out.start_dir = zip_out.fp.tell()
+    zip_out._didModify = True
+
+
+class Book:
+    """
+    Access to the members of an ePub during processing.
+    Paths are POSIX paths relative to the root of the archive (e.g. "OEBPS/Text/cap1.xhtml"),
+    so stages behave the same whether the book is in memory or extracted to disk.
+    """
+
+    mode = None
+
+    def __init__(self, epub_path):
+        self.epub_path = epub_path
+        self.opf_path = None
+        self.content_dir = None
+        self.index = None
+        # Members written during processing; everything else is copied raw when packaging
+        self.modified = set()
+
+    def _set_opf(self, opf_path):
+        if not opf_path:
+            raise FileNotFoundError("OPF file not found in the ePub.")
+        self.opf_path = opf_path
+        self.content_dir = posixpath.dirname(opf_path)
+
+    def _build_index(self, members):
+        """
+        Builds the index from (path, size) pairs, in archive order.
+        """
+        self.index = BookIndex(self.opf_path)
+        for path, size in members:
+            self.index.add(path, size)
+        self.index.load_manifest(self.read_bytes(self.opf_path))
+
+    def _record_write(self, path, data):
+        self.modified.add(path)
+        self.index.add(path, len(data))
+        if path == self.opf_path:
+            self.index.load_manifest(data)
+
+    def files(self):
+        return iter(self.index)
+
+    def size(self, path):
+        return self.index.size(normalize_path(path))
+
+    def content_files(self, kind=None):
+        """
+        Lists the members inside the content directory (the directory of the OPF),
+        optionally only the ones of a kind of utils.book_index.FILE_KINDS.
+        """
+        return self.index.paths(kind, self.content_dir)
+
+    def read_text(self, path):
+        return self.read_bytes(path).decode('utf-8')
+
+    def write_text(self, path, text):
+        self.write_bytes(path, text.encode('utf-8'))
+
+    def package(self, output_path):
+        """
+        Writes the output ePub. mimetype must be the first file and uncompressed.
+        Members that were not written during processing keep their compressed bytes
+        from the input ePub, so only the changed files are deflated again.
+        """
+        mimetype = b'application/epub+zip'
+        if self.exists('mimetype'):
+            mimetype = self.read_bytes('mimetype')
+
+        copied = 0
+        compressed = 0
+        with zipfile.ZipFile(self.epub_path, 'r') as zip_in, zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+            originals = {normalize_path(info.filename): info for info in zip_in.infolist() if not info.is_dir()}
+            zip_out.writestr('mimetype', mimetype, compress_type=zipfile.ZIP_STORED)
+            raw_copy = can_copy_raw(zip_in, zip_out)
+            if not raw_copy:
+                logging.warning("Raw zip copy not supported by this Python version: recompressing every member.")
+
+            for path in self.files():
+                if path == 'mimetype':
                     continue
+                info = originals.get(path)
+                # Encrypted members are never copied (and can't be processed anyway)
+                if raw_copy and info is not None and path not in self.modified and not info.flag_bits & 0x01:
+                    copy_raw_member(zip_in, info, zip_out, path)
+                    copied += 1
+                else:
+                    zip_out.writestr(path, self.read_bytes(path))
+                    compressed += 1
+
+        logging.info(f"Packaged {output_path}: {compressed} members compressed, {copied} copied unchanged.")
+
+    def close(self):
+        pass
+
+
+class DiskBook(Book):
+    """
+    Book extracted to a work directory. Used as fallback for very large books.
+    """
+
+    mode = 'disk'
+
+    def __init__(self, epub_path, work_dir):
+        super().__init__(epub_path)
+        self.root = work_dir
+        opf_path, _ = extract_epub(epub_path, work_dir)
+
+        opf_in_container = None
+        if self.exists(CONTAINER_PATH):
+            opf_in_container = find_opf_in_container(self.read_bytes(CONTAINER_PATH))
+        if opf_in_container and self.exists(opf_in_container):
+            self._set_opf(opf_in_container)
+        else:
+            self._set_opf(normalize_path(os.path.relpath(opf_path, work_dir)))
+        self._build_index(self._scan())
+
+    def _abs(self, path):
+        return os.path.join(self.root, *normalize_path(path).split('/'))
+
+    def exists(self, path):
+        return os.path.isfile(self._abs(path))
+
+    def _scan(self):
+        for root, _, files in os.walk(self.root):
+            for file in files:
                 file_path = os.path.join(root, file)
-                archive_name = os.path.relpath(file_path, source_dir)
-                zip_out.write(file_path, archive_name)
+                yield normalize_path(os.path.relpath(file_path, self.root)), os.path.getsize(file_path)
+
+    def read_bytes(self, path):
+        with open(self._abs(path), 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, path, data):
+        file_path = self._abs(path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        self._record_write(normalize_path(path), data)
+
+
+class MemoryBook(Book):
+    """
+    Book processed without extraction.
+    Members are read from the input zip on demand, modified and new members are kept
+    in memory and the output zip is written straight from there.
+    """
+
+    mode = 'memory'
+
+    def __init__(self, epub_path):
+        super().__init__(epub_path)
+        self._zip = zipfile.ZipFile(epub_path, 'r')
+        # Original members, in archive order (directory entries are skipped)
+        self._infos = {}
+        for info in self._zip.infolist():
+            if not info.is_dir():
+                self._infos[normalize_path(info.filename)] = info
+        self._written = {}
+
+        opf_path = None
+        if CONTAINER_PATH in self._infos:
+            opf_path = find_opf_in_container(self.read_bytes(CONTAINER_PATH))
+        if not opf_path or not self.exists(opf_path):
+            opf_path = next((path for path in self._infos if path.endswith('.opf')), None)
+        self._set_opf(opf_path)
+        self._build_index((path, info.file_size) for path, info in self._infos.items())
+
+    def exists(self, path):
+        path = normalize_path(path)
+        return path in self._written or path in self._infos
+
+    def read_bytes(self, path):
+        path = normalize_path(path)
+        if path in self._written:
+            return self._written[path]
+        return self._zip.read(self._infos[path])
+
+    def write_bytes(self, path, data):
+        path = normalize_path(path)
+        self._written[path] = data
+        self._record_write(path, data)
+
+    def close(self):
+        self._zip.close()
+
+
+def open_book(epub_path, work_dir, in_memory=True):
+    """
+    Opens an ePub for processing.
+    Books whose uncompressed size exceeds Config.IN_MEMORY_MAX_SIZE (or in_memory=False)
+    are extracted to work_dir instead of being kept in memory.
+    """
+    if in_memory:
+        with zipfile.ZipFile(epub_path, 'r') as zip_ref:
+            total_size = sum(info.file_size for info in zip_ref.infolist())
+        if total_size <= Config.IN_MEMORY_MAX_SIZE:
+            return MemoryBook(epub_path)
+        logging.info(f"Book too large for in-memory mode ({total_size} bytes). Extracting to {work_dir}")
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    return DiskBook(epub_path, work_dir)
@@ -0,0 +1,92 @@
+import re
+from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4.builder import HTMLTreeBuilder
+from bs4.builder._lxml import LXMLTreeBuilderForXML
+from bs4.formatter import XMLFormatter
+from config import Config
+
+PARSERS = ("html.parser", "lxml", "xhtml")
+
+# lxml turns the declaration into a comment (HTML) or rewrites it (XML), so it is kept aside
+XML_DECLARATION = re.compile(r'\s*(<\?xml[^>]*\?>)\s*')
+
+# Elements written as <tag/> when empty; any other empty element keeps its end tag,
+# which HTML based reading systems need (e.g. <script ...></script>)
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'param', 'source', 'track', 'wbr'
+])
+
+
+class XHTMLTreeBuilder(LXMLTreeBuilderForXML):
+    """
+    lxml XML builder for XHTML documents: namespaces are kept as written, class
+    is a list as with the HTML builders, and only the void elements self-close.
+    """
+
+    NAME = "xhtml"
+    features = [NAME]
+    DEFAULT_CDATA_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+    DEFAULT_EMPTY_ELEMENT_TAGS = VOID_ELEMENTS
+
+
+class XHTMLFormatter(XMLFormatter):
+    """
+    Escapes text as XML, except script and style contents: those are written in
+    a CDATA section when they need escaping (lxml hands over CDATA sections as
+    plain text), or as they are when they already hold one.
+    """
+
+    def __init__(self):
+        super().__init__(entity_substitution=XMLFormatter.REGISTRY['minimal'].entity_substitution)
+
+    def substitute(self, ns):
+        if isinstance(ns, NavigableString) and ns.parent is not None and ns.parent.name in ('script', 'style'):
+            if '<![CDATA[' in ns or not ('<' in ns or '&' in ns):
+                return str(ns)
+            return f"<![CDATA[{ns}]]>"
+        return super().substitute(ns)
+
+
+class Soup(BeautifulSoup):
+    """
+    Document parsed by one of the lxml backends: str() writes back the original
+    XML declaration, and XHTML documents with XHTMLFormatter.
+    """
+
+    xml_declaration = None
+
+    def __repr__(self):
+        # Tag.decode: BeautifulSoup.decode would add a declaration of its own to XML documents
+        text = Tag.decode(self, formatter=XHTML_FORMATTER if self.is_xml else "minimal")
+        if self.xml_declaration:
+            return f"{self.xml_declaration}\n{text}"
+        return text
+
+    __str__ = __unicode__ = __repr__
+
+
+XHTML_FORMATTER = XHTMLFormatter()
+
+
+def parse(text, parser=None):
+    """
+    Parses an XHTML document with the configured backend (Config.HTML_PARSER):
+    html.parser (default), lxml (lxml HTML parser) or xhtml (lxml XML parser).
+    The result is serialized back with str().
+    """
+    parser = parser or Config.HTML_PARSER
+    if parser == "html.parser":
+        return BeautifulSoup(text, 'html.parser')
+    if parser not in PARSERS:
+        raise ValueError(f"Unknown HTML parser '{parser}' (expected one of {', '.join(PARSERS)})")
+
+    declaration = XML_DECLARATION.match(text)
+    if declaration:
+        text = text[declaration.end():]
+    if parser == "xhtml":
+        soup = Soup(text, builder=XHTMLTreeBuilder)
+    else:
+        soup = Soup(text, 'lxml')
+    soup.xml_declaration = declaration.group(1) if declaration else None
+    return soup
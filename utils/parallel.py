@@ -0,0 +1,59 @@
+import time
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+def _timed_task(task, text):
+    """
+    Runs task in the worker and returns its wall and CPU time along with the result.
+    """
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    result = task(text)
+    return time.perf_counter() - start_wall, time.process_time() - start_cpu, result
+
+
+class FileExecutor:
+    """
+    Runs file-local stage work on a process pool, one task per document.
+    A task is a module level function taking the document text and returning
+    (new_text, result). new_text is None when the document is unchanged.
+    Only changed documents get their text replaced (and their tree dropped).
+    """
+
+    def __init__(self, workers, profiler=None):
+        self.workers = workers
+        self.profiler = profiler
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        logging.info(f"Per-file executor started with {workers} workers.")
+
+    def map_documents(self, task, docs):
+        """
+        Runs task over the documents and returns the list of results, in document order.
+        The profiler gets the time each worker spent on a file, so docs must not come
+        from the timed store iterator (use store.untimed() or gated(..., timed=False)).
+        """
+        docs = list(docs)
+        if not docs:
+            return []
+
+        texts = [doc.text for doc in docs]
+        results = []
+
+        for doc, (wall, cpu, (new_text, result)) in zip(docs, self._pool.map(partial(_timed_task, task), texts)):
+            if self.profiler:
+                self.profiler.record_file(doc.path, wall, cpu)
+            if new_text is not None:
+                doc.text = new_text
+            results.append(result)
+
+        return results
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import cProfile
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Collects wall/CPU time per stage and per file, the tracemalloc peak per stage
+    and, optionally, one cProfile dump per stage. A disabled profiler only
+    keeps the stage order and costs nothing.
+    """
+
+    def __init__(self, book_name, enabled=False, report_dir="profiles", cprofile=False):
+        self.book_name = book_name
+        self.enabled = enabled
+        self.report_dir = report_dir
+        self.cprofile = cprofile
+        self.stages = []
+        self._current = None
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        entry = {"name": name, "wall": 0, "cpu": 0, "peak_memory": 0, "files": {}}
+        self.stages.append(entry)
+        self._current = entry
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+        profile = cProfile.Profile() if self.cprofile else None
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if profile:
+            profile.enable()
+
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            entry["wall"] = time.perf_counter() - start_wall
+            entry["cpu"] = time.process_time() - start_cpu
+            entry["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+            if profile:
+                entry["cprofile"] = self._dump_cprofile(profile, name)
+            self._current = None
+
+    def record_file(self, path, wall, cpu):
+        """
+        Adds the time spent on one file to the current stage.
+        """
+        if not self.enabled or self._current is None:
+            return
+        timing = self._current["files"].setdefault(path, {"wall": 0, "cpu": 0})
+        timing["wall"] += wall
+        timing["cpu"] += cpu
+
+    def _dump_cprofile(self, profile, stage_name):
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"{self.book_name}.{stage_name}.prof")
+        profile.dump_stats(path)
+        return path
+
+    def report(self):
+        return {
+            "book": self.book_name,
+            "total_wall": time.perf_counter() - self._start,
+            "stages": self.stages
+        }
+
+    def write_report(self):
+        """
+        Writes the JSON report of the book to report_dir. Returns its path.
+        """
+        if not self.enabled:
+            return None
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"{self.book_name}.profile.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+        logging.info(f"Profile report written to {path}")
+        return path
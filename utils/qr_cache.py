@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from config import Config
+
+
+class QRCache:
+    """
+    Persistent SQLite cache of QR code decoding results, keyed by the hash of the
+    image bytes, so logos and QR codes reused across a series are decoded once.
+    Images without a QR code are stored too (as an empty list).
+    Past max_entries the least recently used results go first.
+    Not thread-safe: use it from the thread that created it.
+    """
+
+    def __init__(self, path=None, max_entries=None):
+        self.path = path or os.path.join(Config.CACHE_DIR, 'qr_codes.sqlite')
+        self.max_entries = Config.QR_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Batch workers share the database, so wait on locks instead of failing
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS decodes ("
+                "key TEXT PRIMARY KEY, payloads TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+        self.evict()
+
+    @staticmethod
+    def key(data, decoder_version):
+        sha = hashlib.sha256(data)
+        sha.update(f"/{decoder_version}".encode('ascii'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the list of QR payloads decoded from the image, or None when it was never scanned.
+        """
+        row = self._conn.execute("SELECT payloads FROM decodes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._conn:
+            self._conn.execute("UPDATE decodes SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put_many(self, results):
+        """
+        Saves {key: payloads} in a single transaction.
+        """
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO decodes (key, payloads, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(payloads), now) for key, payloads in results.items()]
+            )
+
+    def evict(self):
+        """
+        Drops the least recently used results above max_entries.
+        """
+        if not self.max_entries:
+            return
+        with self._conn:
+            removed = self._conn.execute(
+                "DELETE FROM decodes WHERE key IN ("
+                "SELECT key FROM decodes ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+        if removed:
+            logging.info(f"QR cache: evicted {removed} entries.")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
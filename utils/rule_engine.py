@@ -0,0 +1,85 @@
+import re
+
+# Patterns that can't be joined with others: backreferences and named group
+# references depend on group numbers, global flags must start the pattern
+_UNFUSABLE = re.compile(r'\\[1-9]|\(\?P=|^\(\?[aiLmsux]+\)')
+
+# A pattern starting with a literal (two plain characters, the second not quantified) is
+# searched by the regex engine with a fast substring scan, which an alternation loses
+_LITERAL_PREFIX = re.compile(r'[\w<>"=:;#&%@!,/-]{2}(?![?*+{])')
+
+
+class RemovalRules:
+    """
+    Removal regexes (every match replaced by '') compiled once into as few passes
+    as pay off: runs of consecutive patterns without a literal prefix (which the
+    regex engine tries at every position) are joined into one alternation, so the
+    text is walked once for all of them. Patterns with a literal prefix, and the
+    ones that can't be joined, keep a pass of their own.
+    Applying the rules one after the other can let a removal create a match for a
+    later rule; when a combined pass leaves such a match behind, the document is
+    cleaned rule by rule instead, so the result doesn't change (matches of
+    different rules are assumed not to overlap, as for attribute removals).
+    Stateless once built, so it can be shared by the per-file workers.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._single = [re.compile(p) for p in self.patterns]
+        # (compiled pass, rule index of each alternative)
+        self.passes = []
+
+        group = []
+        for i, pattern in enumerate(self.patterns):
+            if _UNFUSABLE.search(pattern) or _LITERAL_PREFIX.match(pattern):
+                self._add_pass(group)
+                self._add_pass([i])
+                group = []
+            else:
+                group.append(i)
+        self._add_pass(group)
+
+    def _add_pass(self, rules):
+        if not rules:
+            return
+        if len(rules) == 1:
+            self.passes.append((self._single[rules[0]], rules))
+            return
+        # Plain groups: capturing ones would make the regex engine several times slower
+        combined = "|".join(f"(?:{self.patterns[i]})" for i in rules)
+        self.passes.append((re.compile(combined), rules))
+
+    def apply(self, text, counts):
+        """
+        Removes the matches of every rule from text, adding the number of matches
+        of each rule to counts (a list with one entry per pattern).
+        Returns the new text.
+        """
+        for regex, rules in self.passes:
+            if len(rules) == 1:
+                text, hits = regex.subn('', text)
+                counts[rules[0]] += hits
+                continue
+
+            hits = [0] * len(rules)
+
+            def remove(match):
+                # The alternation took the first rule matching here
+                for n, i in enumerate(rules):
+                    if self._single[i].match(text, match.start()):
+                        hits[n] += 1
+                        break
+                return ''
+
+            cleaned = regex.sub(remove, text)
+            if any(hits) and regex.search(cleaned):
+                # A removal created a new match: fall back to the sequential order
+                for i in rules:
+                    text, rule_hits = self._single[i].subn('', text)
+                    counts[i] += rule_hits
+                continue
+
+            for n, i in enumerate(rules):
+                counts[i] += hits[n]
+            text = cleaned
+        return text
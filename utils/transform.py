@@ -0,0 +1,85 @@
+from bs4.element import Tag
+
+
+class TreeTransform:
+    """
+    Applies rules to the elements of a parsed document in a single depth-first walk.
+    Rules are registered by tag name and/or class prefix, and called in document
+    order as rule(element, ancestors, deferred): ancestors lists the enclosing
+    elements from the root to the parent (don't keep it, it changes during the walk).
+    A rule returns True when it modified the tree. It may change attributes right
+    away, but structural changes (moving or removing elements) would break the walk:
+    it queues them as callables in deferred instead, run in order after the walk
+    (each returns True if it changed the tree).
+    Stateless once built, so it can be shared by the per-file workers.
+    """
+
+    def __init__(self):
+        # name (None = any tag) -> [(class prefix or None, rule)]
+        self._rules = {}
+        # Whether every rule names its tag, without class prefix (see apply)
+        self._by_tag_only = True
+
+    def rule(self, name=None, class_prefix=None):
+        """
+        Decorator registering a rule for the elements with this tag name and/or a class starting with class_prefix.
+        """
+        def register(func):
+            self._rules.setdefault(name, []).append((class_prefix, func))
+            if name is None or class_prefix is not None:
+                self._by_tag_only = False
+            return func
+        return register
+
+    @staticmethod
+    def _has_class_prefix(element, class_prefix):
+        classes = element.get('class') or ()
+        if isinstance(classes, str):
+            classes = classes.split()
+        return any(cls.startswith(class_prefix) for cls in classes)
+
+    def _dispatch(self, element, ancestors, deferred):
+        modified = False
+        for rules in (self._rules.get(element.name), self._rules.get(None)):
+            if not rules:
+                continue
+            for class_prefix, func in rules:
+                if class_prefix is not None and not self._has_class_prefix(element, class_prefix):
+                    continue
+                if func(element, ancestors, deferred):
+                    modified = True
+        return modified
+
+    def apply(self, soup, index=None):
+        """
+        Runs the rules over the document, then the deferred changes.
+        With the ElementIndex of the document, and rules that all name their tag,
+        only the elements of those tags are visited instead of the whole tree.
+        Returns True if the tree was modified.
+        """
+        modified = False
+        deferred = []
+        if index is not None and self._by_tag_only:
+            for element in index.tags(*self._rules):
+                # The BeautifulSoup object (no parent) is not an ancestor of the walk
+                ancestors = [parent for parent in element.parents if parent.parent is not None]
+                ancestors.reverse()
+                if self._dispatch(element, ancestors, deferred):
+                    modified = True
+        else:
+            ancestors = []
+            for element in soup.descendants:
+                if not isinstance(element, Tag):
+                    continue
+                # Close the elements the walk left since the previous tag
+                parent = element.parent
+                while ancestors and ancestors[-1] is not parent:
+                    ancestors.pop()
+                if self._dispatch(element, ancestors, deferred):
+                    modified = True
+                ancestors.append(element)
+
+        for change in deferred:
+            if change():
+                modified = True
+        return modified
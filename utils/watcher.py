@@ -0,0 +1,83 @@
+import os
+import glob
+import time
+import shutil
+import logging
+import zipfile
+
+
+class FolderWatcher:
+    """
+    Polls a folder for .epub files and reports the ones that finished being written.
+    A file is ready once its size and mtime haven't changed for settle_time seconds
+    and it opens as a complete zip. Files handed out by poll() are ignored until done().
+    """
+
+    def __init__(self, folder, settle_time=2.0, pattern="*.epub"):
+        self.folder = folder
+        self.settle_time = settle_time
+        self.pattern = pattern
+        # path -> ((size, mtime), monotonic time the signature was first seen)
+        self._pending = {}
+        self._in_flight = set()
+        # path -> signature of a settled file that isn't a zip
+        self._invalid = {}
+
+    def poll(self):
+        now = time.monotonic()
+        current = set(glob.glob(os.path.join(self.folder, self.pattern)))
+        ready = []
+
+        for path in sorted(current):
+            if path in self._in_flight:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self._pending.get(path)
+            if previous is None or previous[0] != signature:
+                # New file, or still being written: (re)start the settle timer
+                self._pending[path] = (signature, now)
+                continue
+
+            if now - previous[1] < self.settle_time or self._invalid.get(path) == signature:
+                continue
+            if not zipfile.is_zipfile(path):
+                # Settled but not an ePub; ignored until it's written again
+                logging.warning(f"Ignoring {path}: not a valid zip file.")
+                self._invalid[path] = signature
+                continue
+
+            del self._pending[path]
+            self._invalid.pop(path, None)
+            self._in_flight.add(path)
+            ready.append(path)
+
+        # Forget files removed before they settled
+        for path in list(self._pending):
+            if path not in current:
+                del self._pending[path]
+                self._invalid.pop(path, None)
+
+        return ready
+
+    def done(self, path):
+        self._in_flight.discard(path)
+
+
+def move_processed(path, dest_dir):
+    """
+    Moves a processed input to dest_dir, keeping older files with the same name.
+    Returns the new path.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    dest = os.path.join(dest_dir, os.path.basename(path))
+    if os.path.exists(dest):
+        name, ext = os.path.splitext(os.path.basename(path))
+        dest = os.path.join(dest_dir, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}{ext}")
+    shutil.move(path, dest)
+    logging.info(f"Moved {path} -> {dest}")
+    return dest